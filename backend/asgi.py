@@ -0,0 +1,151 @@
+"""
+ASGI entry point, for serving the backend with an ASGI server (ie, `uvicorn backend.asgi:application`) instead of Flask's WSGI server.
+
+Endpoints with `async def` handlers are awaited directly on the server's event loop (and `stream_endpoint` events are sent from it as they're produced), so a single process can hold hundreds of in-flight requests that are waiting on Gemini or the LaTeX compiler. Every other route (the synchronous handlers, /metrics, etc.) is run through the regular Flask app in a worker thread. Either way, the request is parsed and the response encoded by the same code as under WSGI, so the JSON/multipart formats are unchanged.
+"""
+import io, sys, asyncio, concurrent.futures
+from werkzeug.exceptions import HTTPException
+
+from . import app as routes #Importing the handlers registers their routes
+from .utils import app, endpoints, config, EventStream
+
+ASGI_THREADS=int(config.get("ASGI_THREADS", 64)) #Worker threads for synchronous routes and blocking calls made by async handlers
+
+def build_environ(scope, body):
+    server=scope.get("server") or ("localhost", 80)
+    client=scope.get("client") or ("", 0)
+
+    environ={
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    for name, value in scope.get("headers", []):
+        name=name.decode("latin-1").upper().replace("-", "_")
+        value=value.decode("latin-1")
+
+        if name=="CONTENT_TYPE":
+            environ["CONTENT_TYPE"]=value
+        elif name!="CONTENT_LENGTH": #The body has already been read in full, so its actual length is used instead
+            key="HTTP_"+name
+            environ[key]=(environ[key]+","+value) if key in environ else value
+
+    return environ
+
+def call_wsgi(wsgi_app, environ):
+    """
+    Calls a WSGI application (which includes Flask responses), and returns the status code, headers, and body iterable
+    """
+    started={}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"]=int(status.split(" ", 1)[0])
+        started["headers"]=headers
+
+    iterable=wsgi_app(environ, start_response)
+    return started["status"], started["headers"], iterable
+
+async def read_body(receive):
+    chunks=[]
+    size=0
+    limit=app.config["MAX_CONTENT_LENGTH"]
+
+    while True:
+        message=await receive()
+        if message["type"]=="http.disconnect":
+            return None
+
+        chunk=message.get("body", b"")
+        size+=len(chunk)
+        chunks.append(chunk if limit is None else chunk[:max(0, limit+1-(size-len(chunk)))]) #Keep one byte past the limit (cutting off the chunk that crosses it), so that Flask still notices the body is too big and returns a 413
+
+        if not message.get("more_body", False):
+            return b"".join(chunks)[:None if limit is None else limit+1]
+
+async def handle_async_endpoint(runner, environ):
+    with app.request_context(environ):
+        try:
+            response=await runner()
+            if isinstance(response, EventStream): #Sent as it's produced, on this loop
+                return 200, [("Content-Type", response.content_type), *response.headers.items()], response
+
+            response=app.make_response(response)
+        except HTTPException as e: #ie, the body was too large to parse
+            response=e.get_response(environ)
+
+        return call_wsgi(response, environ)
+
+async def send_response(send, status, headers, iterable):
+    await send({"type": "http.response.start", "status": status, "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]})
+
+    if isinstance(iterable, EventStream):
+        try:
+            async for chunk in iterable:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            await iterable.aclose()
+
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+        return
+
+    iterator=iter(iterable)
+    try:
+        if isinstance(iterable, (list, tuple)):
+            for chunk in iterator:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        else:
+            while True:
+                chunk=await asyncio.to_thread(next, iterator, None) #Streamed bodies may block while producing the next chunk
+                if chunk is None:
+                    break
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    finally:
+        close=getattr(iterable, "close", None)
+        if close is not None:
+            close()
+
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+async def lifespan(receive, send):
+    while True:
+        message=await receive()
+        if message["type"]=="lifespan.startup":
+            asyncio.get_running_loop().set_default_executor(concurrent.futures.ThreadPoolExecutor(ASGI_THREADS, thread_name_prefix="asgi-worker"))
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"]=="lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def application(scope, receive, send):
+    if scope["type"]=="lifespan":
+        return await lifespan(receive, send)
+    elif scope["type"]!="http":
+        return
+
+    body=await read_body(receive)
+    if body is None: #The client went away
+        return
+
+    environ=build_environ(scope, body)
+
+    runner=endpoints.get(scope["path"]) if scope["method"]=="POST" else None
+    if runner is not None:
+        status, headers, iterable=await handle_async_endpoint(runner, environ)
+    else:
+        status, headers, iterable=await asyncio.to_thread(call_wsgi, app.wsgi_app, environ)
+
+    await send_response(send, status, headers, iterable)
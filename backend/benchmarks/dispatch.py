@@ -0,0 +1,89 @@
+"""
+Measures the per-request overhead of dispatching a handler, before (sys.settrace-based PersistentLocals) and after (dispatch.Handler).
+
+Run from the repository root with `python -m backend.benchmarks.dispatch`. This doesn't touch Flask, Supabase, etc. so no .env is needed.
+"""
+import sys, json, timeit, argparse
+
+from ..dispatch import Handler
+
+class PersistentLocals(object): #The dispatch engine that `endpoint` used before, kept here as the baseline
+    def __init__(self, func, locals_dict):
+        self._locals = {}
+        self.func = func
+        self.locals_dict=locals_dict
+
+    def __call__(self, *args, **kwargs): #https://code.activestate.com/recipes/577283-decorator-to-expose-local-variables-of-a-function-/
+        def tracer(frame, event, arg):
+            frame.f_trace_lines=False
+            frame.f_trace_opcodes=False
+
+            if (frame.f_code==self.func.__code__):
+                if event=='return':
+                    self._locals = frame.f_locals.copy()
+                elif event=='call':
+                    frame.f_locals.update(self.locals_dict)
+                    frame.f_globals.update(self.locals_dict)
+
+                    return tracer
+            else:
+                frame.f_trace=old_trace
+
+        old_trace=sys.gettrace()
+        sys.settrace(tracer)
+        try:
+            res=self.func(*args, **kwargs)
+        finally:
+            sys.settrace(old_trace)
+        return res
+
+    @property
+    def locals(self):
+        return self._locals
+
+def library_call(depth): #Stands in for the nested calls made inside supabase, google.genai, PyGithub, etc.
+    if depth==0:
+        return json.loads(json.dumps({"id": 1, "filename": "resume"}))
+    return library_call(depth-1)
+
+def empty():
+    pass
+
+def light():
+    info=[library_call(5) for _ in range(job_listing)]
+
+def heavy():
+    info=[library_call(20) for _ in range(job_listing)]
+
+def before(func, parameters_map):
+    persistent_locals=PersistentLocals(func, parameters_map)
+    persistent_locals()
+    return persistent_locals.locals
+
+def after(handler, parameters_map):
+    local_variables={}
+    handler(local_variables, parameters_map)
+    return local_variables
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=2000, help="Requests per measurement")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Measurements per handler (the best one is reported)")
+    args=parser.parse_args()
+
+    parameters_map={"job_listing": 20, "token": None}
+
+    print(f"{'handler':<8}{'before (us)':>14}{'after (us)':>14}{'speedup':>10}")
+    for func in [empty, light, heavy]:
+        handler=Handler(func, ["job_listing", "token"])
+
+        assert before(func, parameters_map).keys()-{"job_listing", "token"}==after(handler, parameters_map).keys()-{"job_listing", "token"}
+
+        results=[]
+        for engine, target in [(before, func), (after, handler)]:
+            results.append(min(timeit.repeat(lambda: engine(target, parameters_map), number=args.number, repeat=args.repeat))/args.number*1e6)
+
+        print(f"{func.__name__:<8}{results[0]:>14.2f}{results[1]:>14.2f}{results[0]/results[1]:>9.1f}x")
+
+if __name__=="__main__":
+    main()
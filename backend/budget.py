@@ -0,0 +1,88 @@
+"""
+Keeps prompts within a token budget.
+
+Token counts are estimated from the length of the text, instead of asking Gemini to count them (which would be another round trip). Inputs are first compacted (badges, images, HTML, and repeated whitespace are removed), and if the prompt is still too long, the lowest-ranked texts are cut down first.
+"""
+import re
+
+from . import metrics
+
+CHARS_PER_TOKEN=4 #A rough average for English text and code
+
+TRUNCATION_MARKER=" [...]"
+
+NOISE_PATTERNS=[
+    re.compile(r"<!--.*?-->", re.S), #HTML comments
+    re.compile(r"\[!\[[^\]]*\]\([^)]*\)\]\([^)]*\)"), #Linked badges, ie, [![Build](https://...svg)](https://...)
+    re.compile(r"!\[[^\]]*\]\([^)]*\)"), #Images
+    re.compile(r"</?[a-zA-Z][^<>\n]*>"), #HTML tags (their text is kept)
+]
+
+def estimate_tokens(text):
+    return -(-len(text)//CHARS_PER_TOKEN)
+
+def compact(text):
+    """
+    Removes the parts of a README (or job listing) that don't mean anything to the model, and collapses repeated whitespace
+    """
+    for pattern in NOISE_PATTERNS:
+        text=pattern.sub("", text)
+
+    text=re.sub(r"[ \t]+", " ", text)
+    text=re.sub(r" ?\n ?", "\n", text)
+    text=re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
+
+def truncate(text, tokens):
+    """
+    Cuts `text` down to about `tokens` tokens, at a word boundary if possible
+    """
+    if estimate_tokens(text)<=tokens:
+        return text
+
+    limit=max(tokens*CHARS_PER_TOKEN-len(TRUNCATION_MARKER), 0)
+    cut=text.rfind(" ", 0, limit+1)
+    if cut<limit//2: #No nearby word boundary
+        cut=limit
+    return text[:cut].rstrip()+TRUNCATION_MARKER
+
+def fit(fixed, ranked, limit, floor=256):
+    """
+    Returns the texts in `ranked` (highest priority first), trimmed so that they and `fixed` fit in `limit` tokens. Starting from the lowest-ranked text, the texts are cut down to `floor` tokens, then dropped. The first text is only cut once every other text has been dropped.
+
+    The number of tokens that were cut is recorded under `prompt_trimmed_tokens_total`.
+    """
+    texts=list(ranked)
+    sizes=[estimate_tokens(text) for text in texts]
+
+    excess=estimate_tokens(fixed)+sum(sizes)-limit
+    if excess<=0:
+        return texts
+    trimmed=0
+
+    def shrink(i, tokens):
+        nonlocal excess, trimmed
+        texts[i]=truncate(texts[i], tokens)
+
+        removed=sizes[i]-estimate_tokens(texts[i])
+        excess-=removed
+        trimmed+=removed
+        sizes[i]-=removed
+
+    for i in range(len(texts)-1, 0, -1): #Lowest-ranked first
+        if excess<=0:
+            break
+        if sizes[i]>floor:
+            shrink(i, max(sizes[i]-excess, floor))
+
+    while excess>0 and len(texts)>1:
+        texts.pop()
+        removed=sizes.pop()
+        excess-=removed
+        trimmed+=removed
+
+    if excess>0 and len(texts)>0:
+        shrink(0, max(sizes[0]-excess, floor))
+
+    metrics.increment("prompt_trimmed_tokens_total", trimmed, route=metrics.current_route.get())
+    return texts
@@ -0,0 +1,180 @@
+"""
+In-process (and on-disk) caches shared by the rest of the backend
+"""
+import threading, time, collections, os, pathlib, tempfile
+
+class LRUCache:
+    """
+    Thread-safe mapping that holds at most `maxsize` entries, evicting the least recently used entry first. If `ttl` is given, entries also expire `ttl` seconds after they were set.
+    """
+
+    _missing=object()
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize=maxsize
+        self.ttl=ttl
+
+        self._data=collections.OrderedDict() #Maps keys to (expiry, value)
+        self._lock=threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry=self._data.get(key, self._missing)
+            if entry is self._missing:
+                return default
+
+            expiry, value=entry
+            if (expiry is not None) and (expiry<=time.monotonic()):
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expiry=None if self.ttl is None else time.monotonic()+self.ttl
+
+        with self._lock:
+            self._data[key]=(expiry, value)
+            self._data.move_to_end(key)
+
+            while len(self._data)>self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry=self._data.pop(key, self._missing)
+
+        if entry is self._missing:
+            return default
+        return entry[1]
+
+    def discard_where(self, predicate):
+        """
+        Removes every entry for which `predicate(key, value)` is true. Returns the number of entries removed.
+        """
+        with self._lock:
+            keys=[key for key, (expiry, value) in self._data.items() if predicate(key, value)]
+            for key in keys:
+                del self._data[key]
+
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self._missing) is not self._missing
+
+    def __len__(self):
+        return len(self._data)
+
+class BlobCache:
+    """
+    Content-addressed cache for byte strings (ie, compiled PDFs), with an in-memory tier holding at most `max_bytes`, and an optional on-disk tier (one file per key under `path`) holding at most `max_disk_bytes`. Both tiers evict the least recently used entries first.
+
+    Keys must be safe to use as filenames (ie, hex digests).
+    """
+
+    def __init__(self, max_bytes=64*1024*1024, path=None, max_disk_bytes=1024*1024*1024):
+        self.max_bytes=max_bytes
+        self.path=None if path is None else pathlib.Path(path)
+        self.max_disk_bytes=max_disk_bytes
+
+        self._data=collections.OrderedDict()
+        self._size=0
+        self._lock=threading.Lock()
+
+        self._disk=collections.OrderedDict() #Maps the keys on disk to their sizes (least recently used first), so that `set` doesn't have to list the directory
+        self._disk_size=0
+
+        if self.path is not None:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._scan_disk()
+
+    def get(self, key):
+        """
+        Returns (value, tier), where tier is "memory", "disk", or None if the key isn't cached
+        """
+        with self._lock:
+            value=self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+                return value, "memory"
+
+        if self.path is None:
+            return None, None
+
+        file=self.path / key
+        try:
+            value=file.read_bytes()
+            os.utime(file) #Marks it as recently used
+        except FileNotFoundError:
+            return None, None
+
+        self._remember(key, value)
+        self._track_disk(key, len(value))
+        return value, "disk"
+
+    def set(self, key, value):
+        self._remember(key, value)
+
+        if self.path is not None:
+            with tempfile.NamedTemporaryFile(dir=self.path, delete=False, prefix=".") as file: #Written under another name first, so that readers never see a partial file
+                file.write(value)
+            os.replace(file.name, self.path / key)
+
+            self._track_disk(key, len(value))
+            if self._disk_size>self.max_disk_bytes:
+                self._evict_disk()
+
+    def _remember(self, key, value):
+        if len(value)>self.max_bytes:
+            return
+
+        with self._lock:
+            previous=self._data.pop(key, None)
+            if previous is not None:
+                self._size-=len(previous)
+
+            self._data[key]=value
+            self._size+=len(value)
+
+            while self._size>self.max_bytes:
+                _, evicted=self._data.popitem(last=False)
+                self._size-=len(evicted)
+
+    def _track_disk(self, key, size):
+        with self._lock:
+            self._disk_size+=size-self._disk.pop(key, 0)
+            self._disk[key]=size
+
+    def _scan_disk(self):
+        """
+        Lists the files on disk, least recently used first. Other processes may share the directory, so this is the source of truth whenever the tracked size says it's time to evict.
+        """
+        files=[]
+        for file in self.path.iterdir():
+            if file.name.startswith("."):
+                continue
+            try:
+                stat=file.stat()
+            except FileNotFoundError: #Evicted by another thread or process
+                continue
+            files.append((stat.st_mtime, stat.st_size, file))
+        files.sort(key=lambda entry: entry[0])
+
+        with self._lock:
+            self._disk=collections.OrderedDict((file.name, size) for _, size, file in files)
+            self._disk_size=sum(self._disk.values())
+        return files
+
+    def _evict_disk(self):
+        for _, size, file in self._scan_disk():
+            if self._disk_size<=self.max_disk_bytes:
+                break
+            file.unlink(missing_ok=True)
+            with self._lock:
+                if self._disk.pop(file.name, None) is not None:
+                    self._disk_size-=size
@@ -8,7 +8,15 @@ import boto3, dateutil
 
 dotenv.load_dotenv()
 
-os.environ["TF_VAR_lambda_handler"]=shlex.quote(open("main.py").read()).replace("\n", r"\n")
+def printf_source(path):
+    """
+    Returns the contents of `path` as a shell-quoted format string that makes printf write the file back out
+    """
+    source=open(path).read().replace("\\", "\\\\").replace("%", "%%")
+    return shlex.quote(source).replace("\n", r"\n")
+
+os.environ["TF_VAR_lambda_handler"]=printf_source("main.py")
+os.environ["TF_VAR_latex_driver"]=printf_source("../../docker/latex_driver.py") #Shared with the Docker compiler
 os.environ["TF_VAR_region"]=os.environ["AWS_DEFAULT_REGION"]
 
 name=os.path.basename(os.path.dirname(__file__))
@@ -2,6 +2,10 @@ variable "lambda_handler" {
 	type = string
 }
 
+variable "latex_driver" {
+	type = string
+}
+
 variable "region" {
 	type = string
 }
@@ -55,7 +59,7 @@ resource "aws_imagebuilder_component" "HelloWorld" {
 
 resource "aws_imagebuilder_container_recipe" "compile-latex" {
   container_type           = "DOCKER"
-  version                  = "0.0.1" //The ONLY version line you need to change
+  version                  = "0.0.12" //The ONLY version line you need to change
   dockerfile_template_data = <<-EOT
         FROM {{{ imagebuilder:parentImage }}}
         {{{ imagebuilder:environments }}}
@@ -66,6 +70,7 @@ resource "aws_imagebuilder_container_recipe" "compile-latex" {
 	RUN pip3 install --break-system-packages awslambdaric
 
 	RUN printf ${var.lambda_handler} > /main.py
+	RUN printf ${var.latex_driver} > /latex_driver.py
 
         WORKDIR "/"
         ENTRYPOINT [ "python3", "-m", "awslambdaric" ]
@@ -1,31 +1,76 @@
-import os, subprocess, json, base64
+import json, base64, gzip, time, os
 
-def main(event, context):
-    os.chdir("/tmp")
-    os.system("rm -rf *")
+import latex_driver #Copied next to this file from docker/latex_driver.py by deploy.py
 
-    if "body" in event:
-        params=json.loads(event["body"])
-    else:
-        params=event
+PYTHON_MEMORY=48 #MB kept for this process (and the runtime), out of the function's memory
+
+#Under the function's 60 second timeout, so that a document that never finishes gets a proper error instead. Likewise, pdflatex's memory is capped under the function's, so that a runaway document fails an allocation (ie, memory_limit) instead of getting the whole runtime killed. The cap is on address space, which is more than pdflatex actually uses, so if pdflatex can't even start under it, give the function more memory rather than raising the cap.
+limits=latex_driver.Limits(timeout=45, cpu_time=40, memory=(int(os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", 128))-PYTHON_MEMORY) << 20)
+
+#Everything under /tmp survives between invocations on a warm start, so the driver deliberately keeps its state there: the waiting pdflatex, the preamble formats (and the preambles that couldn't be dumped), and the fonts TeX generates (since the rest of the filesystem is read only). Each invocation compiles in its own directory, which the driver deletes once it's done.
+driver=latex_driver.Driver(workers=1, limits=limits, keep_fonts=True) #A Lambda only handles one invocation at a time
+driver.start()
+
+MAX_BATCH_SIZE=50
 
-    filename=params["filename"]
+BATCH_MARGIN=5 #Seconds left before the function times out to send back the results. Documents that haven't started by then are reported as timing out.
 
-    with open(filename+".tex", "w+") as f:
-        f.write(params["content"])
+def read_params(event):
+    """
+    Reads the parameters from a function URL request (whose body may be base64-encoded and/or gzipped), or from a direct invocation
+    """
+    if "body" not in event:
+        return event
 
-    process=subprocess.run(["pdflatex", "-interaction=nonstopmode", filename+".tex"], capture_output=True, text=True)
+    body=event["body"]
+    if event.get("isBase64Encoded", False):
+        body=base64.b64decode(body)
+
+    headers={key.lower(): value for key, value in event.get("headers", {}).items()}
+    if headers.get("content-encoding", "")=="gzip":
+        body=gzip.decompress(body)
+
+    return json.loads(body)
+
+def batch(documents, context):
+    """
+    Compiles every document in turn (the function only has enough memory for one pdflatex), until the function is about to time out. A function URL can't stream its response from Python, so the lines that the Docker compiler would stream (see latex_driver.batch_result) are sent back all at once.
+    """
+    if not isinstance(documents, list) or not all(isinstance(document, str) for document in documents) or not 0<len(documents)<=MAX_BATCH_SIZE:
+        return json.dumps({
+        "headers": {"Error-Message": f"documents must be a list of 1 to {MAX_BATCH_SIZE} LaTeX documents"},
+        "statusCode": 400,
+        "body": "",
+        'isBase64Encoded': False
+        })
+
+    deadline=time.monotonic()+context.get_remaining_time_in_millis()/1000-BATCH_MARGIN
+    lines=[json.dumps(latex_driver.batch_result(index, pdf, log, code)) for index, pdf, log, code in latex_driver.compile_all(lambda latex: driver.compile(latex, strict=True, deadline=deadline), documents, 1)]
+
+    return json.dumps({
+    "headers": {"Content-Type": "application/x-ndjson"},
+    "statusCode": 200,
+    "body": base64.b64encode("".join(line+"\n" for line in lines).encode()).decode(),
+    'isBase64Encoded': True
+    })
+
+def main(event, context):
+    params=read_params(event)
+
+    if "documents" in params: #ie, a request to /batch
+        return batch(params["documents"], context)
+
+    pdf, log, code=driver.compile(params["content"], strict=True)
 
     status_code=200
     headers={}
     body=b""
-    if process.returncode>0:
+    if pdf is None:
         status_code=500
-        headers["Error-Message"]=process.stdout
-
-    filename+=".pdf"
-    if os.path.exists(filename):
-        body=open(filename, "rb").read()
+        headers["Error-Message"]=latex_driver.LIMIT_MESSAGES.get(code, log)
+        headers["Error-Code"]=code
+    else:
+        body=pdf
 
     return json.dumps({
     "headers": headers,
@@ -0,0 +1,48 @@
+"""
+Trace-free dispatch for `endpoint` handlers.
+
+Handlers are written as if their parameters were already defined, and implicitly "return" whatever locals they define. Instead of tracing the handler on every call to inject and extract those locals, the handler is recompiled once (at decoration time) so that every parameter becomes a real argument, and its locals are copied out when it exits (whether it returns or raises).
+
+Since the parameters are now ordinary locals, each request gets its own namespace --- nothing is written into the module's globals anymore.
+
+Handlers can also be coroutine functions (`async def`), in which case calling the Handler returns a coroutine that must be awaited, or async generator functions, in which case it returns an async generator.
+"""
+import ast, inspect, textwrap
+
+LOCALS="__endpoint_locals__" #Name of the hidden argument that receives the handler's locals
+
+class Handler:
+    def __init__(self, func, parameters):
+        self.func=func
+        self.parameters=list(dict.fromkeys(parameters)) #Remove duplicates (ie, "token" being passed explicitly), while preserving order
+
+        self.is_async=inspect.iscoroutinefunction(func)
+        self.is_async_generator=inspect.isasyncgenfunction(func)
+
+        self._compiled=self._compile()
+
+    def _compile(self):
+        func=self.func
+        tree=ast.parse(textwrap.dedent(inspect.getsource(func)))
+
+        definition=tree.body[0]
+        definition.decorator_list=[] #Don't register the route a second time
+
+        definition.args=ast.arguments(posonlyargs=[], args=[ast.arg(arg=name) for name in [LOCALS, *self.parameters]], vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[])
+
+        capture=ast.parse(f"{LOCALS}.update(locals())\n{LOCALS}.pop('{LOCALS}', None)").body
+        definition.body=[ast.Try(body=definition.body, handlers=[], orelse=[], finalbody=capture)]
+
+        ast.fix_missing_locations(tree)
+        ast.increment_lineno(tree, func.__code__.co_firstlineno-1) #Keep tracebacks pointing at the original lines
+
+        namespace={}
+        exec(compile(tree, inspect.getsourcefile(func), "exec"), func.__globals__, namespace)
+
+        return namespace[definition.name]
+
+    def __call__(self, local_variables, parameters_map):
+        """
+        Runs the handler with the values in `parameters_map`, and stores its locals in `local_variables`. The locals are stored even if the handler raises an exception (or, for a generator, once it's exhausted or closed).
+        """
+        return self._compiled(local_variables, **{name: parameters_map.get(name) for name in self.parameters})
@@ -0,0 +1,110 @@
+"""
+Content-addressed cache for embeddings.
+
+Embeddings are keyed by (model, task_type, sha256(text)), so the same text is only ever sent to the embedding API once per model, no matter which user or route asked for it. Recently used embeddings are kept in memory, and every embedding is also written to a local SQLite database, so that they survive restarts.
+"""
+import hashlib, sqlite3, threading, array, pathlib, asyncio
+
+from .cache import LRUCache
+from . import metrics
+
+def digest(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+class EmbeddingCache:
+    def __init__(self, maxsize=4096, path=None):
+        """
+        If `path` is None, only the in-memory tier is used
+        """
+        self.memory=LRUCache(maxsize)
+
+        self.path=path
+        self._connection=None
+        self._lock=threading.Lock() #sqlite3 connections can't be used by several threads at once
+
+        if path is not None:
+            pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+            self._connection=sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT NOT NULL, task_type TEXT NOT NULL, digest TEXT NOT NULL, vector BLOB NOT NULL, PRIMARY KEY (model, task_type, digest))")
+
+    def get_many(self, model, task_type, texts):
+        """
+        Returns a list with the embedding of each text, or None where it isn't cached
+        """
+        keys=[(model, task_type, digest(text)) for text in texts]
+        embeddings=[self.memory.get(key) for key in keys]
+
+        missing={key for key, embedding in zip(keys, embeddings) if embedding is None}
+        found={}
+
+        if missing and self._connection is not None:
+            with self._lock:
+                for key in missing:
+                    row=self._connection.execute("SELECT vector FROM embeddings WHERE model = ? AND task_type = ? AND digest = ?", key).fetchone()
+                    if row is not None:
+                        found[key]=array.array("d", row[0]).tolist()
+
+            for key, embedding in found.items():
+                self.memory.set(key, embedding)
+
+        counts={"memory": 0, "disk": 0, "miss": 0}
+        for i, key in enumerate(keys):
+            if embeddings[i] is not None:
+                counts["memory"]+=1
+            elif key in found:
+                embeddings[i]=found[key]
+                counts["disk"]+=1
+            else:
+                counts["miss"]+=1
+
+        for result, count in counts.items():
+            metrics.increment("embedding_cache_total", count, result=result)
+
+        return embeddings
+
+    def set_many(self, model, task_type, texts, embeddings):
+        rows=[]
+        for text, embedding in zip(texts, embeddings):
+            key=(model, task_type, digest(text))
+            self.memory.set(key, list(embedding))
+            rows.append((*key, array.array("d", embedding).tobytes()))
+
+        if self._connection is not None:
+            with self._lock:
+                self._connection.executemany("INSERT OR REPLACE INTO embeddings (model, task_type, digest, vector) VALUES (?, ?, ?, ?)", rows)
+
+    def _split(self, model, task_type, texts):
+        embeddings=self.get_many(model, task_type, texts)
+        misses=list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None)) #A text that's repeated within the batch only needs to be sent once
+        return embeddings, misses
+
+    def _merge(self, model, task_type, texts, embeddings, misses, fetched):
+        if len(fetched)!=len(misses):
+            raise ValueError(f"Expected {len(misses)} embeddings, but got {len(fetched)}")
+
+        self.set_many(model, task_type, misses, fetched)
+
+        fetched=dict(zip(misses, fetched))
+        return [fetched[text] if embedding is None else embedding for text, embedding in zip(texts, embeddings)]
+
+    def resolve(self, model, task_type, texts, fetch):
+        """
+        Returns the embedding of each text, in order. Only the texts that aren't cached are passed to `fetch`, which should return their embeddings in the same order.
+        """
+        embeddings, misses=self._split(model, task_type, texts)
+        if len(misses)==0:
+            return embeddings
+
+        return self._merge(model, task_type, texts, embeddings, misses, fetch(misses))
+
+    async def aresolve(self, model, task_type, texts, fetch):
+        """
+        Same as `resolve`, but `fetch` is a coroutine function. The SQLite tier is read and written in a thread, so that it doesn't block the event loop
+        """
+        embeddings, misses=await asyncio.to_thread(self._split, model, task_type, texts)
+        if len(misses)==0:
+            return embeddings
+
+        return await asyncio.to_thread(self._merge, model, task_type, texts, embeddings, misses, await fetch(misses))
@@ -1,27 +1,33 @@
 from .utils import *
-import io, base64
+from . import sections, budget
+import io, base64, re, gzip
 
-@endpoint("/generate/rag", ["job_listing"], ["repos"])
-def rag():
-    #By default, all of the returned repos should be marked as "checked" on the frontend --- the user can uncheck any of the projects they feel do not match
+async def match_repos(token, job_listing):
+    embedding=(await aget_embeddings(token, [job_listing]))[0]
 
-    ids=User.rpc("match_projects", {"uid": get_uid_from_token(token), "query_embedding": get_embeddings(token, [job_listing])[0], "minimum_score": (0 if app.testing else 0.5), "count": 10}).execute().data #Can tweak the minimum and/or count
+    return await rank_repos(token, embedding)
 
-    repos=User.table("user_to_project").select("id, name, url").in_("id", ids).execute().data
+async def rank_repos(token, embedding):
+    return await asyncio.to_thread(retriever.match_projects, get_uid_from_token(token), embedding, minimum_score=(0 if app.testing else 0.5), count=10) #Can tweak the minimum and/or count
 
-@endpoint("/generate/points", ["ids", "job_listing"], ["output"])
-def points():
-    #The user should be asked if they want to recreate the points, as well as edit the points manually if needed
+@endpoint("/generate/rag", ["job_listing"], ["repos"])
+async def rag():
+    #By default, all of the returned repos should be marked as "checked" on the frontend --- the user can uncheck any of the projects they feel do not match
 
-    projects=User.table("user_to_project").select("text").in_("id", ids).eq("uid", get_uid_from_token(token)).execute().data
+    repos=await match_repos(token, job_listing)
 
-    
-    if len(projects)==0: #Raise an error when there's nothing that is returned
-        raise ValueError("No projects available to use in generation!")
+def points_prompt(job_listing, projects):
+    """
+    `projects` should be ordered from most to least relevant, as the least relevant ones are trimmed first if the prompt is over budget
+    """
+    job_listing=budget.truncate(budget.compact(job_listing or ""), PROMPT_TOKEN_BUDGET//4)
+    projects=budget.fit(points_template(job_listing, []), [budget.compact(project) for project in projects], PROMPT_TOKEN_BUDGET)
 
+    return points_template(job_listing, projects)
+
+def points_template(job_listing, projects):
     project_separator="\n\n"
-    output=llm(token,
-    f"""
+    return f"""
     You are helping to format a user's GitHub projects so that it can be inserted into their resume.
 
     Here is the job listing:
@@ -30,24 +36,17 @@ def points():
 
     Here are some potentially relevant projects that the user has selected for inclusion in their resume:
 
-    {project_separator.join([project["text"] for project in projects])}
+    {project_separator.join(projects)}
 
     Summarize the list of projects into a list of projects that can be inserted into the resume. You are free to remove any project from the list if they are not in fact relevant.
 
     It is imperative that you ONLY return a bullet point list, nothing else.
     """
-    )
 
+PROJECTS_SECTION=r"project" #Matches the title of the section the points go into
 
-@endpoint("/generate/latex", ["input", "resume_id"], ["output", "filename"])
-def latex():
-    #The user should be asked if they want to recreate/edit the returned latex code
-    #llm should strip first
-
-    resume=User.table("user_to_resume").select("filename, content").eq("id", resume_id).eq("uid", get_uid_from_token(token)).execute().data[0]
-
-    output=llm(token,
-    f"""
+def latex_prompt(resume, input):
+    return f"""
 You are editing the resume of a user to include some of their personal GitHub projects.
 
     Here is the LaTeX resume they want to edit:
@@ -61,28 +60,394 @@ You are editing the resume of a user to include some of their personal GitHub pr
     Integrate the bullet point list into the resume in a way that maintains the cohesion of the resume's theme, style, and structure --- do not just paste in the list without any consideration.
 
     Return JUST the modified resume, nothing more.
-    """)
+    """
+
+def section_prompt(section, sample, input):
+    return f"""
+You are editing the projects section of a user's LaTeX resume to include some of their personal GitHub projects.
+
+    Here is the section they want to edit:
+
+    {section}
+
+    Here is another section of the same resume, to show its style:
+
+    {sample}
+
+    Here is the bullet point list they want to include:
+
+    {input}
+
+    Integrate the bullet point list into the section in a way that maintains the cohesion of the resume's theme, style, and structure --- do not just paste in the list without any consideration. Only use commands that already appear in the section or the sample.
+
+    Return JUST the modified section (starting with its \\section line), nothing more.
+    """
+
+def clean_latex(output):
+    output=re.sub(r"^```(?:latex|tex)?[ \t]*\n?", "", output.strip())
+    return re.sub(r"\n?```$", "", output)
+
+def latex_edit(resume, input):
+    """
+    Returns the prompt for editing `resume`, and a function that turns the model's response into the full, cleaned up resume.
+
+    If the resume has a projects section, only that section (and a short sample of another one) is sent, and the rewritten section is spliced back in. Otherwise, the whole resume is sent.
+    """
+    content=resume["content"]
+    input=budget.compact(input or "") #The resume itself is left alone, since the model copies its formatting
+
+    section=sections.find_section(content, PROJECTS_SECTION)
+    if section is None:
+        return latex_prompt(resume, input), clean_latex
+
+    prompt=section_prompt(sections.text_of(content, section).strip(), sections.style_sample(content, section), input)
+
+    def finish(output):
+        output=clean_latex(output)
+        if "\\begin{document}" in output: #The model ignored the instructions and returned the whole resume
+            return output
+        return sections.splice(content, section, output)
+
+    return prompt, finish
+
+async def get_projects(token, ids):
+    projects=await asyncio.to_thread(repository.get_project_texts, get_uid_from_token(token), ids)
+
+    if len(projects)==0: #Raise an error when there's nothing that is returned
+        raise ValueError("No projects available to use in generation!")
+    return projects
+
+async def get_resume(token, resume_id):
+    resume=await asyncio.to_thread(repository.get_resume, get_uid_from_token(token), resume_id)
+
+    if resume is None:
+        raise ValueError("Current user does not have permission to access the resume at the given id")
+    return resume
+
+@endpoint("/generate/points", ["ids", "job_listing", "regenerate"], ["output"])
+async def points():
+    #The user should be asked if they want to recreate the points, as well as edit the points manually if needed. Recreating them should pass "regenerate", so that a cached response isn't returned
 
-    output=output.strip("```latex").rstrip("```")
+    projects=await get_projects(token, ids)
+
+    output=await allm(token, points_prompt(job_listing, projects), regenerate=bool(regenerate))
+
+@stream_endpoint("/generate/points/stream", ["ids", "job_listing", "regenerate"], ["output"])
+async def points_stream():
+    #Same as /generate/points, but the points are sent as {"chunk": ...} events while they're being generated
+
+    projects=await get_projects(token, ids)
+
+    chunks=[]
+    async for chunk in allm_stream(token, points_prompt(job_listing, projects), regenerate=bool(regenerate)):
+        chunks.append(chunk)
+        yield {"chunk": chunk}
+
+    output="".join(chunks)
+
+@endpoint("/generate/latex", ["input", "resume_id", "regenerate"], ["output", "filename"])
+async def latex():
+    #The user should be asked if they want to recreate/edit the returned latex code (recreating it should pass "regenerate")
+    #llm should strip first
+
+    resume=await get_resume(token, resume_id)
+
+    prompt, finish=latex_edit(resume, input)
+
+    output=finish(await allm(token, prompt, regenerate=bool(regenerate)))
 
     filename=resume["filename"]
 
-@endpoint("/generate/pdf", ["filename", "content"], [File("file")])
-def pdf():
-    response=requests.post(config["LATEX_COMPILER_URL"], json={"filename": filename+".tex", "content": content}).json()
+@stream_endpoint("/generate/latex/stream", ["input", "resume_id", "regenerate"], ["output", "filename"])
+async def latex_stream():
+    #Same as /generate/latex, but the raw response (ie, just the rewritten section) is sent as {"chunk": ...} events while it's being generated. The final event has the full, cleaned up output
 
-    if (response["statusCode"]!=200) and (not app.testing): #We'll disable error checking for now. We'll re-enable it once we get Gemini to produce valid LaTeX.
-        raise ValueError(response["headers"]["Error-Message"])
-    else:
-        body=response["body"]
-        if response["isBase64Encoded"]:
-            body=base64.b64decode(body)
+    resume=await get_resume(token, resume_id)
 
-        file=io.BytesIO(body)
-        
-        file.name=filename+".pdf"
+    prompt, finish=latex_edit(resume, input)
 
+    chunks=[]
+    async for chunk in allm_stream(token, prompt, regenerate=bool(regenerate)):
+        chunks.append(chunk)
+        yield {"chunk": chunk}
+
+    output=finish("".join(chunks))
+
+    filename=resume["filename"]
 
+class CompilerError(ValueError):
+    pass
 
+class CompilerTimeoutError(CompilerError):
+    pass
+
+class CompilerCPULimitError(CompilerError):
+    pass
+
+class CompilerMemoryLimitError(CompilerError):
+    pass
+
+class CompilerOutputLimitError(CompilerError):
+    pass
+
+COMPILER_ERRORS={"timeout": CompilerTimeoutError, "cpu_limit": CompilerCPULimitError, "memory_limit": CompilerMemoryLimitError, "output_limit": CompilerOutputLimitError} #Maps the compiler's Error-Code header to the error /generate/pdf reports. Anything else is a CompilerError
+
+def pdf_key(content):
+    return hashlib.sha256(f"{COMPILER_VERSION}\n{content}".encode()).hexdigest()
+
+def compiler_request(params):
+    """
+    Returns the body and headers of a request to the compiler
+    """
+    request=json.dumps(params).encode()
+    headers={"Content-Type": "application/json"}
+    if COMPILER_COMPRESS:
+        request=gzip.compress(request)
+        headers["Content-Encoding"]="gzip"
+    return request, headers
+
+async def compile_pdf(filename, content):
+    key=pdf_key(content)
+
+    body, tier=await asyncio.to_thread(pdf_cache.get, key)
+    metrics.increment("pdf_cache_total", result=tier or "miss")
+    if body is not None: #The same LaTeX was compiled before, so there's no need to ask the compiler again
+        return body
+
+    request, headers=compiler_request({"filename": filename+".tex", "content": content})
+
+    with timer("compiler"):
+        if COMPILER_PROTOCOL=="binary": #The PDF comes back as is, with any error in the headers
+            response=await get_compiler_client().post(config["LATEX_COMPILER_URL"], content=request, headers=headers|{"Accept": "application/pdf"})
+
+            status_code=response.status_code
+            error=response.headers.get("Error-Message", response.text if status_code!=200 else "")
+            code=response.headers.get("Error-Code", "")
+            body=response.content
+        else: #The Lambda's JSON envelope
+            response=(await get_compiler_client().post(config["LATEX_COMPILER_URL"], content=request, headers=headers)).json()
+
+            status_code=response["statusCode"]
+            error=response["headers"].get("Error-Message", "")
+            code=response["headers"].get("Error-Code", "")
+            body=response["body"]
+            if response["isBase64Encoded"]:
+                body=base64.b64decode(body)
+
+    if code in COMPILER_ERRORS: #There's no PDF at all, so these are always raised
+        raise COMPILER_ERRORS[code](error)
+    if (status_code!=200) and (not app.testing): #We'll disable error checking for now. We'll re-enable it once we get Gemini to produce valid LaTeX.
+        raise CompilerError(error)
+
+    if status_code==200:
+        await asyncio.to_thread(pdf_cache.set, key, body)
+    return body
+
+async def compile_pdfs(contents):
+    """
+    Compiles every document in `contents` with a single request to the compiler's /batch endpoint (which compiles them in parallel), and yields each one's index along with its PDF, or the error that compile_pdf would have raised, as soon as the compiler sends it. Cached PDFs are yielded first, without asking the compiler.
+    """
+    keys=[pdf_key(content) for content in contents]
+
+    pending=[] #Indices of the documents that have to be compiled
+    for index, key in enumerate(keys):
+        body, tier=await asyncio.to_thread(pdf_cache.get, key)
+        metrics.increment("pdf_cache_total", result=tier or "miss")
+        if body is not None:
+            yield index, body
+        else:
+            pending.append(index)
+
+    if len(pending)==0:
+        return
+
+    async def results(lines):
+        async for line in lines:
+            if not line:
+                continue
+            result=json.loads(line)
+            index=pending[result["index"]]
+
+            if result["status"]=="ok":
+                body=base64.b64decode(result["pdf"])
+                await asyncio.to_thread(pdf_cache.set, keys[index], body)
+                yield index, body
+            elif result["code"] in COMPILER_ERRORS or not app.testing: #Same as compile_pdf
+                yield index, COMPILER_ERRORS.get(result["code"], CompilerError)(result["error"])
+            else:
+                yield index, b""
+
+    request, headers=compiler_request({"documents": [contents[index] for index in pending]})
+    url=config["LATEX_COMPILER_URL"].rstrip("/")+"/batch"
+
+    with timer("compiler"):
+        if COMPILER_PROTOCOL=="binary": #Each document's line is streamed as soon as it's compiled
+            async with get_compiler_client().stream("POST", url, content=request, headers=headers) as response:
+                if response.status_code!=200:
+                    raise CompilerError((await response.aread()).decode(errors="replace"))
+
+                async for result in results(response.aiter_lines()):
+                    yield result
+        else: #The Lambda can't stream its response, so every line comes at once in its JSON envelope
+            response=(await get_compiler_client().post(url, content=request, headers=headers)).json()
+            if response["statusCode"]!=200:
+                raise CompilerError(response["headers"].get("Error-Message", ""))
+
+            body=response["body"]
+            if response["isBase64Encoded"]:
+                body=base64.b64decode(body).decode()
+
+            async def lines():
+                for line in body.splitlines():
+                    yield line
+
+            async for result in results(lines()):
+                yield result
+
+@endpoint("/generate/pdf", ["filename", "content"], [File("file")])
+async def pdf():
+    file=io.BytesIO(await compile_pdf(filename, content))
     
+    file.name=filename+".pdf"
+
+@stream_endpoint("/generate/pipeline", ["job_listing", "resume_id", "ids", "points", "latex", "regenerate"], ["repos", "points", "latex", "filename", "pdf"])
+async def pipeline():
+    #Runs /generate/rag, /generate/points, /generate/latex, and /generate/pdf in a single request, sending {"stage": ..., "status": ...} events as it goes (and {"stage": ..., "chunk": ...} events while Gemini is generating)
+    #Stages the user has already approved are skipped by passing their output: "ids" skips rag, "points" skips points, and "latex" skips latex. The PDF is returned base64-encoded in the final event
+
+    resume_task=asyncio.create_task(get_resume(token, resume_id)) #Independent of the other stages, so it's fetched while they run
+    resume_task.add_done_callback(lambda task: task.cancelled() or task.exception()) #Its error is raised when it's awaited, so don't also log it as unretrieved if an earlier stage fails first
+    try:
+        if ids is None:
+            yield {"stage": "rag", "status": "running"}
+            repos=await match_repos(token, job_listing)
+            ids=[x["id"] for x in repos]
+            yield {"stage": "rag", "status": "done", "repos": repos}
+        else:
+            yield {"stage": "rag", "status": "skipped"}
+
+        if points is None:
+            yield {"stage": "points", "status": "running"}
+            chunks=[]
+            async for chunk in allm_stream(token, points_prompt(job_listing, await get_projects(token, ids)), regenerate=bool(regenerate)):
+                chunks.append(chunk)
+                yield {"stage": "points", "chunk": chunk}
+            points="".join(chunks)
+            yield {"stage": "points", "status": "done"}
+        else:
+            yield {"stage": "points", "status": "skipped"}
+
+        resume=await resume_task
+        filename=resume["filename"]
+
+        if latex is None:
+            yield {"stage": "latex", "status": "running"}
+            prompt, finish=latex_edit(resume, points)
+            chunks=[]
+            async for chunk in allm_stream(token, prompt, regenerate=bool(regenerate)):
+                chunks.append(chunk)
+                yield {"stage": "latex", "chunk": chunk}
+            latex=finish("".join(chunks))
+            yield {"stage": "latex", "status": "done"}
+        else:
+            yield {"stage": "latex", "status": "skipped"}
+
+        yield {"stage": "pdf", "status": "running"}
+        pdf=base64.b64encode(await compile_pdf(filename, latex)).decode()
+        yield {"stage": "pdf", "status": "done"}
+    finally:
+        resume_task.cancel() #In case an earlier stage failed
+
+BATCH_CONCURRENCY=int(config.get("BATCH_CONCURRENCY", 4)) #Listings in a batch that are tailored at the same time
+MAX_BATCH_SIZE=int(config.get("MAX_BATCH_SIZE", 50))
+
+async def tailor(token, index, job_listing, embedding, resume_task, regenerate, compile=True):
+    """
+    Runs the points, latex, and pdf stages (unless `compile` is False) for a single listing of a batch. Errors are returned instead of raised, so that one bad listing doesn't fail the others
+    """
+    try:
+        repos=await rank_repos(token, embedding)
+        ids=[x["id"] for x in repos]
+
+        points=await allm(token, points_prompt(job_listing, await get_projects(token, ids)), regenerate=regenerate)
+
+        resume=await resume_task
+        prompt, finish=latex_edit(resume, points)
+        latex=finish(await allm(token, prompt, regenerate=regenerate))
+
+        result={"index": index, "repos": repos, "points": points, "latex": latex, "filename": resume["filename"], "error": "", "message": ""}
+        if compile:
+            result["pdf"]=base64.b64encode(await compile_pdf(resume["filename"], latex)).decode()
+        return result
+    except Exception as e:
+        return {"index": index, "error": e.__class__.__name__, "message": str(e)}
+
+async def compile_as_ready(tasks):
+    """
+    Yields the results of `tasks` (from `tailor`, without their PDFs) once they're compiled. Whenever the compiler is free, every result that's ready by then is compiled in a single request to its /batch endpoint, so listings that finish together share a request
+    """
+    ready=asyncio.Queue()
+    for task in tasks:
+        task.add_done_callback(ready.put_nowait)
+
+    remaining=len(tasks)
+    while remaining>0:
+        done=[await ready.get()]
+        while not ready.empty():
+            done.append(ready.get_nowait())
+        remaining-=len(done)
+
+        results=[task.result() for task in done]
+        for result in results:
+            if result["error"]:
+                yield result
+        results=[result for result in results if not result["error"]]
+        if len(results)==0:
+            continue
+
+        sent=set()
+        try:
+            async for index, pdf in compile_pdfs([result["latex"] for result in results]):
+                sent.add(index)
+                if isinstance(pdf, Exception):
+                    yield {"index": results[index]["index"], "error": pdf.__class__.__name__, "message": str(pdf)}
+                else:
+                    yield results[index]|{"pdf": base64.b64encode(pdf).decode()}
+        except Exception as e: #The whole request failed, so every document that wasn't sent yet failed with it
+            for index, result in enumerate(results):
+                if index not in sent:
+                    yield {"index": result["index"], "error": e.__class__.__name__, "message": str(e)}
+
+@stream_endpoint("/generate/batch", ["job_listings", "resume_id", "regenerate"], ["count"])
+async def batch():
+    #Runs the whole pipeline for each of `job_listings` against the same resume. Each listing's result (with its "index" in `job_listings`) is sent as an event as soon as it's done, so they can arrive out of order
+
+    if not isinstance(job_listings, list) or len(job_listings)==0:
+        raise ValueError("job_listings must be a non-empty list")
+    if len(job_listings)>MAX_BATCH_SIZE:
+        raise ValueError(f"At most {MAX_BATCH_SIZE} job listings can be tailored at once")
+
+    resume_task=asyncio.create_task(get_resume(token, resume_id))
+    resume_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    embeddings=await aget_embeddings(token, job_listings) #One request for the whole batch
+
+    semaphore=asyncio.Semaphore(BATCH_CONCURRENCY)
+    async def limited(index, embedding):
+        async with semaphore:
+            return await tailor(token, index, job_listings[index], embedding, resume_task, bool(regenerate), compile=not COMPILER_BATCH)
 
+    tasks=[asyncio.create_task(limited(index, embedding)) for index, embedding in enumerate(embeddings)]
+    try:
+        count=0
+        if COMPILER_BATCH:
+            async for result in compile_as_ready(tasks):
+                yield result
+                count+=1
+        else:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+                count+=1
+    finally:
+        for task in [*tasks, resume_task]: #In case the client went away
+            task.cancel()
@@ -11,13 +11,31 @@ def link():
     #Assumes token is valid
     if value=="":
         value=None
-    user_to_token_table.upsert({"uid": get_uid_from_token(token), column: value}).execute()
+    uid=get_uid_from_token(token)
+
+    repository.set_token(uid, column, value)
+
+    invalidate_credentials(uid)
 
 #Used solely for displaying the username in the settings page
 @endpoint("/user_to_token/view", ["column"], ["value"])
 def view():
     value=retrieve(token, column) or ""
 
+def instrument_github(user):
+    """
+    Times every request the user's requester makes to the GitHub API (including the ones made by the repos it returns, which share the requester)
+    """
+    requester=user._requester
+    request=requester.requestJsonAndCheck
+
+    def timed_request(*args, **kwargs):
+        with timer("github"):
+            return request(*args, **kwargs)
+
+    requester.requestJsonAndCheck=timed_request
+    return user
+
 def get_github_user_from_token(token):
     _token=retrieve(token, "github")
     _username=NotSet
@@ -26,7 +44,7 @@ def get_github_user_from_token(token):
         _token=config["TEST_USER_GITHUB_TOKEN"]
         _username=retrieve(token, "github_username")
 
-    return Github(auth=Auth.Token(_token)).get_user(_username)
+    return get_client((get_uid_from_token(token), "github", _token, _username), lambda: instrument_github(Github(auth=Auth.Token(_token)).get_user(_username)))
 
 @endpoint("/github/projects/list", ["min_stars", "is_archived", "include", "exclude", "only"], ["repos"])
 def list():
@@ -98,31 +116,28 @@ def _import():
 
     embeddings=get_embeddings(token, [x["text"] for x in data])
 
-    data=[{"uid": uid, "embedding": embeddings[i]} | x for i, x in enumerate(data)] #Merge them back together
+    data=[{"embedding": embeddings[i]} | x for i, x in enumerate(data)] #Merge them back together
 
     """
     The text in each row of user_to_project will be combined to create a single text. Each project will be "<column_name>: <str(value)>" concatenated into a single string. Use gemini embeddings (https://ai.google.dev/gemini-api/docs/embeddings), and follow this: https://supabase.com/docs/guides/ai/semantic-search#semantic-search-in-postgres (try gte-small as well). Vectors are stored alongside the project
     """
 
-    User.table("user_to_project").delete().eq("uid", uid).execute() #Clear all projects associated with the user
-
-    User.table("user_to_project").insert(data).execute()
+    repository.replace_projects(uid, data) #Clears all projects associated with the user, then inserts the new ones
+    invalidate_projects(uid)
 
 @endpoint("/github/projects/view", [], ["repos"])
 def view_projects():
-    repos=User.table("user_to_project").select("name, url").eq("uid", get_uid_from_token(token)).execute().data
+    repos=repository.list_projects(get_uid_from_token(token))
 
 #/github/selection --- stores JSON mapping between name of project and whether it was selected on the frontend during project import. /get can be used to retrieve it, and /set can be used to, well, set it.
 @endpoint("/github/selection/set", ["data"])
 def _set():
-    User.table("user_to_selection").upsert({"uid": get_uid_from_token(token), "data": data}).execute()
+    repository.set_selection(get_uid_from_token(token), data)
 
 @endpoint("/github/selection/get", [], ["data"])
 def _get():
-    data=User.table("user_to_selection").select("data").eq("uid", get_uid_from_token(token)).execute().data
+    data=repository.get_selection(get_uid_from_token(token))
 
-    if len(data)==0:
+    if data is None:
         data={}
-    else:
-        data=data[0]["data"]
 
@@ -0,0 +1,161 @@
+"""
+Lightweight counters and histograms, rendered in the Prometheus text format.
+
+Each thread records into its own shard, so recording never takes a lock. Shards are only merged when the metrics are rendered, and a shard is folded into `retired` once its thread has exited, so that short-lived request threads don't pile up.
+"""
+import threading, time, weakref, contextlib, contextvars, bisect
+
+PREFIX="resumetailor_"
+
+BUCKETS=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) #In seconds. LLM calls can take tens of seconds
+
+TOKEN_BUCKETS=(256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072)
+
+buckets={"prompt_tokens": TOKEN_BUCKETS} #Histograms that aren't in seconds
+
+current_route=contextvars.ContextVar("current_route", default="") #Set by `endpoint`, so that helpers don't need to know which route called them
+
+descriptions={
+    "requests_total": "Requests handled, by route and status code",
+    "request_seconds": "Total time spent handling a request, by route",
+    "stage_seconds": "Time spent in each stage of a request, by route and stage",
+    "llm_cache_total": "Lookups in the LLM response cache, by result",
+    "prompt_tokens": "Estimated size of the prompts sent to Gemini, by route",
+    "prompt_trimmed_tokens_total": "Estimated tokens cut from prompts to fit PROMPT_TOKEN_BUDGET, by route",
+    "gemini_wait_seconds": "Time spent waiting for a Gemini rate limit before each call, by pool (user keys, or the shared key)",
+    "gemini_queue_depth": "Calls currently waiting for a Gemini rate limit, by pool",
+    "gemini_retries_total": "Gemini calls retried after a 429 or 5xx, by status code",
+    "pdf_cache_total": "PDF compiles, by where the PDF was found (memory, disk, or miss)",
+    "embedding_cache_total": "Embedding lookups, by where they were found (memory, disk, or miss)",
+}
+
+class Shard:
+    def __init__(self):
+        self.counters={} #Maps (name, labels) to a number
+        self.histograms={} #Maps (name, labels) to [bucket counts..., sum, count]
+
+_shards=weakref.WeakSet()
+_retired=Shard()
+_gauges={}
+_lock=threading.RLock() #Only taken when a thread records for the first time, when a thread exits, and when rendering
+_local=threading.local()
+
+def _merge(into, shard):
+    for key, value in list(shard.counters.items()):
+        into.counters[key]=into.counters.get(key, 0)+value
+
+    for key, value in list(shard.histograms.items()):
+        existing=into.histograms.get(key)
+        if existing is None:
+            into.histograms[key]=list(value)
+        else:
+            for i, x in enumerate(value):
+                existing[i]+=x
+
+def _retire(counters, histograms):
+    shard=Shard()
+    shard.counters=counters
+    shard.histograms=histograms
+
+    with _lock:
+        _merge(_retired, shard)
+
+def _shard():
+    shard=getattr(_local, "shard", None)
+    if shard is None:
+        shard=_local.shard=Shard()
+
+        weakref.finalize(shard, _retire, shard.counters, shard.histograms) #The thread-local is the only strong reference, so this runs when the thread exits
+        with _lock:
+            _shards.add(shard)
+    return shard
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+def increment(name, amount=1, **labels):
+    counters=_shard().counters
+    key=(name, _labels(labels))
+    counters[key]=counters.get(key, 0)+amount
+
+def set_gauge(name, value, **labels): #Gauges are kept process-wide, since a per-thread value doesn't mean anything on its own
+    with _lock:
+        _gauges[(name, _labels(labels))]=value
+
+def observe(name, value, **labels):
+    histograms=_shard().histograms
+    key=(name, _labels(labels))
+
+    bounds=buckets.get(name, BUCKETS)
+
+    histogram=histograms.get(key)
+    if histogram is None:
+        histogram=histograms[key]=[0]*(len(bounds)+3) #Bucket counts (including +Inf), then sum, then count
+
+    histogram[bisect.bisect_left(bounds, value)]+=1
+    histogram[-2]+=value
+    histogram[-1]+=1
+
+@contextlib.contextmanager
+def timer(stage, **labels):
+    """
+    Records how long the block took under `stage_seconds`, labelled with the current route
+    """
+    start=time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("stage_seconds", time.perf_counter()-start, route=current_route.get(), stage=stage, **labels)
+
+def _format_labels(labels, extra=()):
+    labels=(*labels, *extra)
+    if len(labels)==0:
+        return ""
+
+    escaped=(str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{"+",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped))+"}"
+
+def snapshot():
+    """
+    Returns a single Shard with everything recorded so far (and the current gauges)
+    """
+    total=Shard()
+    with _lock:
+        _merge(total, _retired)
+        for shard in list(_shards):
+            _merge(total, shard)
+        gauges=dict(_gauges)
+
+    return total, gauges
+
+def render():
+    total, gauges=snapshot()
+    lines=[]
+
+    def header(name, kind):
+        if descriptions.get(name):
+            lines.append(f"# HELP {PREFIX}{name} {descriptions[name]}")
+        lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+    for kind, items in [("counter", total.counters), ("gauge", gauges)]:
+        names=sorted({name for name, _ in items})
+        for name in names:
+            header(name, kind)
+            for (_name, labels), value in sorted(items.items()):
+                if _name==name:
+                    lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+
+    for name in sorted({name for name, _ in total.histograms}):
+        header(name, "histogram")
+        for (_name, labels), histogram in sorted(total.histograms.items()):
+            if _name!=name:
+                continue
+
+            cumulative=0
+            for bound, count in zip((*buckets.get(name, BUCKETS), "+Inf"), histogram[:-2]):
+                cumulative+=count
+                lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {histogram[-2]}")
+            lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {histogram[-1]}")
+
+    return "\n".join(lines)+"\n"
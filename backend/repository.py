@@ -0,0 +1,256 @@
+"""
+Data access for the tables used on the hot path.
+
+SQLRepository runs its queries directly over a pooled SQLAlchemy engine, while PostgrestRepository goes through the supabase client (one HTTPS request per query). Both have the same methods, so handlers don't need to care which one they're given.
+"""
+import re, json, functools
+import sqlalchemy as sql
+
+TOKEN_COLUMNS=["github", "github_username", "gemini"] #The columns of user_to_token that can be read and written
+
+def parse_vector(value): #pgvector sends vectors as text, ie, "[1,2,3]"
+    return json.loads(value) if isinstance(value, str) else value
+
+def in_order(ids, projects): #Returns the texts in the same order as `ids` (ie, most relevant first)
+    rank={int(id): i for i, id in reversed(list(enumerate(ids)))}
+    return [project["text"] for project in sorted(projects, key=lambda project: rank[int(project["id"])])]
+
+class PostgrestRepository:
+    def __init__(self, client):
+        self.client=client
+
+    def get_token(self, uid, column):
+        data=self.client.table("user_to_token").select(column).eq("uid", uid).execute().data
+        if len(data)==0:
+            return None
+        return data[0][column]
+
+    def set_token(self, uid, column, value):
+        self.client.table("user_to_token").upsert({"uid": uid, column: value}).execute()
+
+    def list_resumes(self, uid):
+        return self.client.table("user_to_resume").select("id, filename").eq("uid", uid).execute().data
+
+    def get_resume_owner(self, id):
+        data=self.client.table("user_to_resume").select("uid").eq("id", id).execute().data
+        if len(data)==0:
+            return None
+        return data[0]["uid"]
+
+    def get_resume(self, uid, id):
+        data=self.client.table("user_to_resume").select("filename, content").eq("id", id).eq("uid", uid).execute().data
+        if len(data)==0:
+            return None
+        return data[0]
+
+    def add_resume(self, uid, filename, content):
+        self.client.table("user_to_resume").insert({"uid": uid, "filename": filename, "content": content}).execute()
+
+    def update_resume(self, id, uid, filename, content):
+        self.client.table("user_to_resume").update({"uid": uid, "filename": filename, "content": content}).eq("id", id).execute()
+
+    def rename_resume(self, id, filename):
+        self.client.table("user_to_resume").update({"filename": filename}).eq("id", id).execute()
+
+    def delete_resume(self, id):
+        self.client.table("user_to_resume").delete().eq("id", id).execute()
+
+    def match_projects(self, uid, embedding, minimum_score, count):
+        ids=self.client.rpc("match_projects", {"uid": uid, "query_embedding": embedding, "minimum_score": minimum_score, "count": count}).execute().data
+
+        return self.client.table("user_to_project").select("id, name, url").in_("id", ids).execute().data
+
+    def get_project_texts(self, uid, ids):
+        return in_order(ids, self.client.table("user_to_project").select("id, text").in_("id", ids).eq("uid", uid).execute().data)
+
+    def get_project_embeddings(self, uid):
+        data=self.client.table("user_to_project").select("id, name, url, embedding").eq("uid", uid).order("id").execute().data
+        return [project|{"embedding": parse_vector(project["embedding"])} for project in data]
+
+    def list_projects(self, uid):
+        return self.client.table("user_to_project").select("name, url").eq("uid", uid).execute().data
+
+    def replace_projects(self, uid, projects):
+        self.client.table("user_to_project").delete().eq("uid", uid).execute() #Clear all projects associated with the user
+
+        self.client.table("user_to_project").insert([{"uid": uid} | project for project in projects]).execute()
+
+    def get_selection(self, uid):
+        data=self.client.table("user_to_selection").select("data").eq("uid", uid).execute().data
+        if len(data)==0:
+            return None
+        return data[0]["data"]
+
+    def set_selection(self, uid, data):
+        self.client.table("user_to_selection").upsert({"uid": uid, "data": data}).execute()
+
+class Statement:
+    """
+    A query that is PREPAREd at most once per pooled connection, and then run with EXECUTE. Parameters use the usual `:name` syntax.
+    """
+    parameter_pattern=re.compile(r"(?<![:\w]):(\w+)")
+
+    def __init__(self, name, text):
+        self.name=name
+        self.text=sql.text(text)
+        self.parameters=list(dict.fromkeys(self.parameter_pattern.findall(text)))
+
+        positional=self.parameter_pattern.sub(lambda match: f"${self.parameters.index(match[1])+1}", text)
+        self.prepare=f"PREPARE {name} AS {positional}"
+
+        arguments=", ".join(f":{parameter}" for parameter in self.parameters)
+        self.execute=sql.text(f"EXECUTE {name}({arguments})" if arguments else f"EXECUTE {name}")
+
+def with_fallback(method):
+    """
+    Runs the same method on the repository's fallback if the database can't be reached
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except (sql.exc.OperationalError, sql.exc.InterfaceError):
+            if self.fallback is None:
+                raise
+            return getattr(self.fallback, method.__name__)(*args, **kwargs)
+    return wrapper
+
+class SQLRepository:
+    statements={statement.name: statement for statement in [
+        *[Statement(f"get_token_{column}", f"SELECT {column} FROM user_to_token WHERE uid = :uid LIMIT 1") for column in TOKEN_COLUMNS],
+        *[Statement(f"set_token_{column}", f"INSERT INTO user_to_token (uid, {column}) VALUES (:uid, :value) ON CONFLICT (uid) DO UPDATE SET {column} = EXCLUDED.{column}") for column in TOKEN_COLUMNS],
+
+        Statement("list_resumes", "SELECT id, filename FROM user_to_resume WHERE uid = :uid ORDER BY id"),
+        Statement("get_resume_owner", "SELECT CAST(uid AS text) AS uid FROM user_to_resume WHERE id = :id LIMIT 1"),
+        Statement("get_resume", "SELECT filename, content FROM user_to_resume WHERE id = :id AND uid = :uid LIMIT 1"),
+        Statement("add_resume", "INSERT INTO user_to_resume (uid, filename, content) VALUES (:uid, :filename, :content)"),
+        Statement("update_resume", "UPDATE user_to_resume SET uid = :uid, filename = :filename, content = :content WHERE id = :id"),
+        Statement("rename_resume", "UPDATE user_to_resume SET filename = :filename WHERE id = :id"),
+        Statement("delete_resume", "DELETE FROM user_to_resume WHERE id = :id"),
+
+        Statement("match_projects", "SELECT p.id, p.name, p.url FROM match_projects(uid => :uid, query_embedding => CAST(:query_embedding AS vector), minimum_score => :minimum_score, count => :count) WITH ORDINALITY AS m(id, rank) JOIN user_to_project p ON p.id = m.id ORDER BY m.rank"),
+        Statement("get_project_texts", "SELECT id, text FROM user_to_project WHERE uid = :uid AND id = ANY(:ids)"),
+        Statement("get_project_embeddings", "SELECT id, name, url, CAST(embedding AS text) AS embedding FROM user_to_project WHERE uid = :uid ORDER BY id"),
+        Statement("list_projects", "SELECT name, url FROM user_to_project WHERE uid = :uid ORDER BY id"),
+        Statement("delete_projects", "DELETE FROM user_to_project WHERE uid = :uid"),
+        Statement("add_project", "INSERT INTO user_to_project (uid, name, url, text, embedding) VALUES (:uid, :name, :url, :text, CAST(:embedding AS vector))"),
+
+        Statement("get_selection", "SELECT data FROM user_to_selection WHERE uid = :uid LIMIT 1"),
+        Statement("set_selection", "INSERT INTO user_to_selection (uid, data) VALUES (:uid, :data) ON CONFLICT (uid) DO UPDATE SET data = EXCLUDED.data"),
+    ]}
+
+    def __init__(self, engine, prepare=True, fallback=None):
+        """
+        `prepare` should be disabled when `engine` goes through a pooler that doesn't keep sessions (ie, PgBouncer in transaction mode), as prepared statements only live as long as the session that made them.
+        """
+        self.engine=engine
+        self.prepare=prepare
+        self.fallback=fallback
+
+    def _execute(self, connection, name, parameters):
+        statement=self.statements[name]
+
+        if not self.prepare:
+            return connection.execute(statement.text, parameters)
+
+        prepared=connection.info.setdefault("prepared_statements", set()) #Lives as long as the underlying DBAPI connection
+        if name not in prepared:
+            connection.exec_driver_sql(statement.prepare)
+            prepared.add(name)
+
+        return connection.execute(statement.execute, parameters)
+
+    def _fetch(self, name, parameters):
+        with self.engine.connect() as connection:
+            return [dict(row._mapping) for row in self._execute(connection, name, parameters)]
+
+    def _run(self, name, parameters): #Runs a single write in its own transaction
+        with self.engine.begin() as connection:
+            self._execute(connection, name, parameters)
+
+    @staticmethod
+    def _check_column(column):
+        if column not in TOKEN_COLUMNS:
+            raise ValueError(f"'{column}' is not a valid column")
+
+    @with_fallback
+    def get_token(self, uid, column):
+        self._check_column(column)
+        data=self._fetch(f"get_token_{column}", {"uid": uid})
+        if len(data)==0:
+            return None
+        return data[0][column]
+
+    @with_fallback
+    def set_token(self, uid, column, value):
+        self._check_column(column)
+        self._run(f"set_token_{column}", {"uid": uid, "value": value})
+
+    @with_fallback
+    def list_resumes(self, uid):
+        return self._fetch("list_resumes", {"uid": uid})
+
+    @with_fallback
+    def get_resume_owner(self, id):
+        data=self._fetch("get_resume_owner", {"id": id})
+        if len(data)==0:
+            return None
+        return data[0]["uid"]
+
+    @with_fallback
+    def get_resume(self, uid, id):
+        data=self._fetch("get_resume", {"uid": uid, "id": id})
+        if len(data)==0:
+            return None
+        return data[0]
+
+    @with_fallback
+    def add_resume(self, uid, filename, content):
+        self._run("add_resume", {"uid": uid, "filename": filename, "content": content})
+
+    @with_fallback
+    def update_resume(self, id, uid, filename, content):
+        self._run("update_resume", {"id": id, "uid": uid, "filename": filename, "content": content})
+
+    @with_fallback
+    def rename_resume(self, id, filename):
+        self._run("rename_resume", {"id": id, "filename": filename})
+
+    @with_fallback
+    def delete_resume(self, id):
+        self._run("delete_resume", {"id": id})
+
+    @with_fallback
+    def match_projects(self, uid, embedding, minimum_score, count):
+        return self._fetch("match_projects", {"uid": uid, "query_embedding": json.dumps(embedding), "minimum_score": minimum_score, "count": count})
+
+    @with_fallback
+    def get_project_texts(self, uid, ids):
+        return in_order(ids, self._fetch("get_project_texts", {"uid": uid, "ids": [int(id) for id in ids]}))
+
+    @with_fallback
+    def get_project_embeddings(self, uid):
+        return [project|{"embedding": parse_vector(project["embedding"])} for project in self._fetch("get_project_embeddings", {"uid": uid})]
+
+    @with_fallback
+    def list_projects(self, uid):
+        return self._fetch("list_projects", {"uid": uid})
+
+    @with_fallback
+    def replace_projects(self, uid, projects):
+        with self.engine.begin() as connection: #Either all of the old projects are replaced, or none of them are
+            self._execute(connection, "delete_projects", {"uid": uid})
+
+            if len(projects)>0:
+                self._execute(connection, "add_project", [{"uid": uid, "name": project["name"], "url": project["url"], "text": project["text"], "embedding": json.dumps(project["embedding"])} for project in projects])
+
+    @with_fallback
+    def get_selection(self, uid):
+        data=self._fetch("get_selection", {"uid": uid})
+        if len(data)==0:
+            return None
+        return data[0]["data"]
+
+    @with_fallback
+    def set_selection(self, uid, data):
+        self._run("set_selection", {"uid": uid, "data": json.dumps(data)})
@@ -3,13 +3,12 @@ import os
 import inspect
 from pathlib import Path
 
-table=User.table("user_to_resume")
 #Validate id by checking the "id" column matches the uid in the token (ie, validate_id(id, token)). Write tests that test this by using invalid ids (ie, either negative or outside the range returned by list)
 
 def validate_id(id): #Checks whether the resume referenced by the id has permission to be accessed by the user in the token
     token=inspect.currentframe().f_back.f_locals["token"]
-    data=table.select("uid").eq("id", id).execute().data
-    if ((len(data)==0) or (data[0]["uid"]!=get_uid_from_token(token))):
+    owner=repository.get_resume_owner(id)
+    if ((owner is None) or (owner!=get_uid_from_token(token))):
         raise ValueError("Current user does not have permission to access the resume at the given id")
 
 @endpoint("/resume/upload", [File("file"), "update"])
@@ -22,20 +21,19 @@ def upload():
     data={"uid": get_uid_from_token(token), "content": file.read().decode(), "filename": filename.stem}
 
     if update is None:
-        action=table.insert(data)
+        repository.add_resume(**data)
     else:
         validate_id(update)
-        action=table.update(data).eq("id", update)
-    action.execute()
+        repository.update_resume(update, **data)
 
 @endpoint("/resume/delete", ["id"])
 def delete():
     validate_id(id)
-    table.delete().eq("id", id).execute()
+    repository.delete_resume(id)
 
 @endpoint("/resume/list", [], ["info"])
 def list():
-    info=table.select("id, filename").execute().data
+    info=repository.list_resumes(get_uid_from_token(token))
 
 @endpoint("/resume/rename", ["id", "name"])
 def rename():
@@ -43,6 +41,6 @@ def rename():
         raise ValueError("New name must end in '.tex'")
 
     validate_id(id)
-    table.update({"filename": Path(name).stem}).eq("id", id).execute()
+    repository.rename_resume(id, Path(name).stem)
     
     
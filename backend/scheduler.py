@@ -0,0 +1,182 @@
+"""
+Throttling and retries for outbound Gemini calls.
+
+Every API key gets its own token bucket, so that one busy user can't use up another's quota, and the shared fallback key (which every user without their own key goes through) gets a separate, usually lower, limit. When Gemini answers with 429 or 5xx, the call is retried with jittered exponential backoff (or after the delay Gemini asked for), and the key's rate is halved, then slowly restored as calls succeed again.
+"""
+import time, random, threading, asyncio, email.utils, re
+
+from google.genai.errors import APIError
+
+from .cache import LRUCache
+from . import metrics
+
+RETRYABLE_CODES={429, 500, 502, 503, 504}
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.max_rate=rate
+        self.rate=rate
+        self.burst=burst
+
+        self.tokens=burst
+        self.updated=time.monotonic()
+        self.blocked_until=0 #Set from Retry-After, so that every caller on the key waits it out
+
+        self._lock=threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token, and returns how long the caller must wait before using it. The token may be borrowed from the future, so that callers queue up in order instead of polling.
+        """
+        with self._lock:
+            now=time.monotonic()
+            self.tokens=min(self.burst, self.tokens+(now-self.updated)*self.rate)
+            self.updated=now
+
+            self.tokens-=1
+            wait=0 if self.tokens>=0 else -self.tokens/self.rate
+
+            return max(wait, self.blocked_until-now)
+
+    def throttle(self, delay=None):
+        with self._lock:
+            self.rate=max(self.rate/2, self.max_rate/16)
+            if delay is not None:
+                self.blocked_until=max(self.blocked_until, time.monotonic()+delay)
+
+    def recover(self):
+        with self._lock:
+            self.rate=min(self.max_rate, self.rate+self.max_rate/20)
+
+def retry_after(error):
+    """
+    Returns how long Gemini asked us to wait (in seconds) before retrying, if it did
+    """
+    response=getattr(error, "response", None)
+    value=getattr(response, "headers", {}).get("Retry-After") if response is not None else None
+    if value:
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            date=email.utils.parsedate_to_datetime(value)
+            if date is not None:
+                return max(date.timestamp()-time.time(), 0)
+
+    details=error.details.get("error", error.details) if isinstance(error.details, dict) else {}
+    for detail in details.get("details", []) if isinstance(details, dict) else []: #ie, {"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "13s"}
+        match=re.fullmatch(r"([\d.]+)s", str(detail.get("retryDelay", "")))
+        if match:
+            return float(match[1])
+    return None
+
+class Scheduler:
+    def __init__(self, rate=2, burst=5, shared_key=None, shared_rate=0.5, shared_burst=5, retries=4, backoff=1, max_backoff=30):
+        """
+        Calls on `shared_key` are limited to `shared_rate` calls per second (across every user), and calls on any other key to `rate` per second per key
+        """
+        self.rate=rate
+        self.burst=burst
+        self.shared_key=shared_key
+        self.retries=retries
+        self.backoff=backoff
+        self.max_backoff=max_backoff
+
+        self.shared=TokenBucket(shared_rate, shared_burst)
+        self.buckets=LRUCache(4096) #Maps API keys to their TokenBucket
+
+        self.waiting={"shared": 0, "user": 0}
+        self._lock=threading.Lock()
+
+    def bucket(self, key):
+        if key==self.shared_key:
+            return self.shared, "shared"
+
+        bucket=self.buckets.get(key)
+        if bucket is None:
+            bucket=TokenBucket(self.rate, self.burst)
+            self.buckets.set(key, bucket)
+        return bucket, "user"
+
+    def _enter(self, pool, wait):
+        metrics.observe("gemini_wait_seconds", wait, pool=pool)
+        if wait<=0:
+            return False
+
+        with self._lock:
+            self.waiting[pool]+=1
+            metrics.set_gauge("gemini_queue_depth", self.waiting[pool], pool=pool)
+        return True
+
+    def _leave(self, pool):
+        with self._lock:
+            self.waiting[pool]-=1
+            metrics.set_gauge("gemini_queue_depth", self.waiting[pool], pool=pool)
+
+    def _retry_delay(self, bucket, error, attempt):
+        """
+        Returns how long to wait before retrying after `error`, or None if it shouldn't be retried
+        """
+        if (not isinstance(error, APIError)) or (error.code not in RETRYABLE_CODES) or (attempt>=self.retries):
+            return None
+
+        delay=retry_after(error)
+        if delay is None:
+            delay=random.uniform(0, min(self.max_backoff, self.backoff*2**attempt)) #"Full jitter", so that callers that failed together don't retry together
+        elif delay>self.max_backoff: #Fail now, instead of holding the request open for that long
+            return None
+
+        bucket.throttle(delay if error.code==429 else None)
+        metrics.increment("gemini_retries_total", code=error.code)
+        return delay
+
+    def call(self, key, function):
+        """
+        Runs `function()` once the key's bucket allows it, retrying it if Gemini is overloaded
+        """
+        bucket, pool=self.bucket(key)
+
+        for attempt in range(self.retries+1):
+            wait=bucket.reserve()
+            if self._enter(pool, wait):
+                try:
+                    time.sleep(wait)
+                finally:
+                    self._leave(pool)
+
+            try:
+                result=function()
+            except Exception as e:
+                delay=self._retry_delay(bucket, e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+
+            bucket.recover()
+            return result
+
+    async def acall(self, key, function):
+        """
+        Same as `call`, but `function` is a coroutine function, and waiting doesn't block the event loop
+        """
+        bucket, pool=self.bucket(key)
+
+        for attempt in range(self.retries+1):
+            wait=bucket.reserve()
+            if self._enter(pool, wait):
+                try:
+                    await asyncio.sleep(wait)
+                finally:
+                    self._leave(pool)
+
+            try:
+                result=await function()
+            except Exception as e:
+                delay=self._retry_delay(bucket, e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+
+            bucket.recover()
+            return result
@@ -0,0 +1,90 @@
+"""
+Splits a LaTeX resume into its `\\section` blocks, so that /generate/latex only has to send (and get back) the section it's changing.
+
+Only `\\section` commands at the start of a line are recognized, so commented out sections (ie, `% \\section{...}`) are skipped. A section runs until the next one, or until `\\end{document}`.
+"""
+import re
+
+SECTION_PATTERN=re.compile(r"^[ \t]*\\section\*?[ \t]*(?:\[[^\]\n]*\])?[ \t]*\{", re.M)
+END_PATTERN=re.compile(r"^[ \t]*\\end\{document\}", re.M)
+
+class Section:
+    def __init__(self, title, start, header_end, end):
+        self.title=title
+        self.start=start #Where the line with the \section command starts
+        self.header_end=header_end #Just after the closing brace of the title
+        self.end=end
+
+def read_group(content, i):
+    """
+    Returns the index just after the brace that closes the one before `i`
+    """
+    depth=1
+    while i<len(content) and depth>0:
+        if content[i]=="\\":
+            i+=2
+            continue
+        elif content[i]=="{":
+            depth+=1
+        elif content[i]=="}":
+            depth-=1
+        i+=1
+    return i
+
+def find_sections(content):
+    end_match=END_PATTERN.search(content)
+    document_end=len(content) if end_match is None else end_match.start()
+
+    sections=[]
+    for match in SECTION_PATTERN.finditer(content, 0, document_end):
+        header_end=read_group(content, match.end())
+        title=content[match.end():header_end-1].strip()
+
+        if sections:
+            sections[-1].end=match.start()
+        sections.append(Section(title, match.start(), header_end, document_end))
+
+    return sections
+
+def find_section(content, pattern):
+    """
+    Returns the first section whose title matches `pattern` (case-insensitively), or None
+    """
+    for section in find_sections(content):
+        if re.search(pattern, section.title, re.I):
+            return section
+    return None
+
+def text_of(content, section):
+    return content[section.start:section.end]
+
+def style_sample(content, exclude, length=1500):
+    """
+    Returns the start of the first section other than `exclude`, cut at a line break, so that the model can copy its formatting
+    """
+    for section in find_sections(content):
+        if section.start==exclude.start:
+            continue
+
+        text=text_of(content, section).strip()
+        if len(text)>length:
+            cut=text.rfind("\n", 0, length)
+            text=text[:cut if cut>0 else length]
+        return text
+    return ""
+
+def splice(content, section, replacement):
+    """
+    Replaces `section` with `replacement`, keeping the whitespace around it. If `replacement` is missing the \\section line, the original one is kept.
+    """
+    original=text_of(content, section)
+    leading=original[:len(original)-len(original.lstrip())]
+    trailing=original[len(original.rstrip()):]
+
+    replacement=replacement.rstrip().lstrip("\n")
+    if SECTION_PATTERN.match(replacement):
+        replacement=replacement.lstrip()
+    else:
+        replacement=content[section.start:section.header_end].strip()+"\n"+replacement
+
+    return content[:section.start]+leading+replacement+trailing+content[section.end:]
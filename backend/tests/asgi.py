@@ -0,0 +1,100 @@
+from . import *
+from ..asgi import application
+
+email=config["TEST_USER_EMAIL"]
+password=config["TEST_USER_PASSWORD"]
+
+credentials={"email": email, "password": password}
+
+def setup(client):
+    global credentials
+    client.post("/signup", json=credentials)
+    token=client.post("/login", json=credentials).json["token"]
+
+    credentials={"token": token}
+
+def request(method, path, body=b"", headers=()):
+    """
+    Sends a single request through the ASGI app, and returns the status code, headers, and body
+    """
+    messages=[{"type": "http.request", "body": body, "more_body": False}]
+    sent=[]
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope={"type": "http", "method": method, "path": path, "query_string": b"", "headers": [(b"content-type", b"application/json"), *headers]}
+
+    asyncio.run(application(scope, receive, send))
+
+    return sent[0]["status"], dict(sent[0]["headers"]), b"".join(message.get("body", b"") for message in sent[1:])
+
+def test_async_endpoint(client):
+    """
+    If a user calls an endpoint with an async handler through the ASGI app, it should respond with the same JSON as under Flask
+    """
+
+    body={"ids": [-1], "job_listing": ""} | credentials
+
+    status, headers, data=request("POST", "/generate/points", json.dumps(body).encode())
+
+    expected=client.post("/generate/points", json=body)
+
+    assert status==expected.status_code==500
+
+    assert json.loads(data)==expected.json
+
+def test_sync_route(client):
+    """
+    If a user calls a route without an async handler through the ASGI app, it should be handled by Flask
+    """
+
+    status, headers, data=request("POST", "/github/selection/get", json.dumps(credentials).encode())
+
+    assert status==200
+
+    assert json.loads(data)==is_success(client.post("/github/selection/get", json=credentials))
+
+def test_stream_endpoint(client):
+    """
+    If a user calls a streaming endpoint through the ASGI app with an invalid id, the error should be in the final server-sent event
+    """
+
+    body={"ids": [-1], "job_listing": ""} | credentials
+
+    status, headers, data=request("POST", "/generate/points/stream", json.dumps(body).encode(), [(b"accept", b"text/event-stream")])
+
+    assert status==200 and headers[b"content-type"]==b"text/event-stream"
+
+    event=json.loads(data.decode().removeprefix("data: "))
+
+    assert event["done"] and event["error"]=="ValueError"
+
+def test_too_large(client):
+    """
+    If a user sends a body larger than MAX_CONTENT_LENGTH through the ASGI app, it should be rejected with a 413, like under Flask
+    """
+
+    body=json.dumps({"content": "x"*app.config["MAX_CONTENT_LENGTH"]} | credentials).encode()
+
+    status, headers, data=request("POST", "/generate/points", body)
+
+    assert status==client.post("/generate/points", data=body, content_type="application/json").status_code==413
+
+def test_stream_metrics(client):
+    """
+    If a user calls a streaming endpoint through the ASGI app, its stage timings should be labelled with the route, and the request should be recorded once the stream ends
+    """
+
+    status, headers, data=request("POST", "/generate/points/stream", json.dumps({"ids": [-1], "job_listing": ""}).encode())
+
+    text=client.get("/metrics").get_data(as_text=True)
+
+    assert 'resumetailor_stage_seconds_count{route="/generate/points/stream",stage="handler"}' in text
+
+    assert 'resumetailor_requests_total{route="/generate/points/stream",status="200"}' in text
+
+    assert 'route="",stage="handler"' not in text
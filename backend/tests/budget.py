@@ -0,0 +1,31 @@
+from . import *
+from .. import budget
+
+def test_compact():
+    """
+    If a README has badges, images, HTML, or repeated whitespace, they should be removed without touching the text
+    """
+
+    readme="""<p align="center"><b>Tool</b></p>
+[![Build](https://img.shields.io/badge.svg)](https://ci.example.com)   ![Logo](logo.png)
+<!-- a comment -->
+
+
+A    fast   tool.  """
+
+    assert budget.compact(readme)=="Tool\n\nA fast tool."
+
+def test_fit():
+    """
+    If the texts are over budget, the lowest-ranked ones should be cut down first, then dropped, but the highest-ranked one should always be kept
+    """
+
+    texts=["a "*400, "b "*400, "c "*400] #200 tokens each
+
+    assert budget.fit("", texts, 1000, floor=50)==texts
+
+    fitted=budget.fit("", texts, 500, floor=50)
+    assert fitted[:2]==texts[:2] and fitted[2].startswith("c c") and budget.estimate_tokens(fitted[2])<=100
+
+    fitted=budget.fit("x"*1200, texts, 500, floor=50)
+    assert len(fitted)==1 and fitted[0].startswith("a a")
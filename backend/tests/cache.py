@@ -0,0 +1,56 @@
+from . import *
+from ..cache import LRUCache, BlobCache
+
+def test_lru_cache():
+    """
+    If an LRUCache is full, the least recently used entry should be evicted first
+    """
+
+    cache=LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert "a" in cache and "b" not in cache and "c" in cache
+
+def test_blob_cache(tmp_path):
+    """
+    If a BlobCache's tiers are over their size limits, the least recently used entries should be evicted, and entries only on disk should still be found
+    """
+
+    cache=BlobCache(max_bytes=10, path=tmp_path, max_disk_bytes=20)
+
+    cache.set("a", b"x"*8)
+    cache.set("b", b"y"*8)
+
+    assert cache.get("a")==(b"x"*8, "disk")
+    assert cache.get("a")==(b"x"*8, "memory")
+
+    cache.set("c", b"z"*8) #Over the disk limit, so "b" (the least recently used) is evicted
+
+    assert cache.get("b")==(None, None)
+    assert cache.get("a")[0]==b"x"*8
+
+    assert BlobCache(path=tmp_path).get("c")==(b"z"*8, "disk")
+
+def test_blob_cache_scans(tmp_path):
+    """
+    If a BlobCache's disk tier is under its size limit, setting an entry shouldn't list the directory, but its size should still be tracked (including entries left by an earlier process)
+    """
+
+    (tmp_path/"old").write_bytes(b"w"*8)
+
+    cache=BlobCache(max_bytes=10, path=tmp_path, max_disk_bytes=20)
+    scan=cache._scan_disk
+    scans=[]
+    cache._scan_disk=lambda: scans.append(None) or scan()
+
+    cache.set("a", b"x"*8)
+    cache.set("a", b"x"*8)
+    assert scans==[] and cache._disk_size==16
+
+    cache.set("b", b"y"*8) #Over the disk limit
+    assert len(scans)==1 and cache._disk_size<=20
+    assert cache.get("b")==(b"y"*8, "memory")
@@ -0,0 +1,281 @@
+from . import *
+import importlib.util, tempfile, threading, time, signal, socket, sys
+
+DOCKER=pathlib.Path(__file__).resolve().parents[2]/"docker"
+sys.path.insert(0, str(DOCKER))
+
+import latex_driver
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    """
+    docker/latex-compiler.py (which can't be imported normally), with its driver's directories under a temporary directory
+    """
+    tempdir=tempfile.tempdir
+    tempfile.tempdir=str(tmp_path_factory.mktemp("latex"))
+    try:
+        spec=importlib.util.spec_from_file_location("latex_compiler", DOCKER/"latex-compiler.py")
+        module=importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        tempfile.tempdir=tempdir
+    return module
+
+def wait_for(condition, timeout=5):
+    deadline=time.monotonic()+timeout
+    while not condition():
+        assert time.monotonic()<deadline
+        time.sleep(0.01)
+
+def test_admission(server):
+    """
+    If every job is running and the queue is full, the next request should be turned away, and a queued request should be let in once a job leaves
+    """
+
+    admission=server.Admission(jobs=1, queue_size=1)
+
+    assert admission.enter()
+
+    admitted=[]
+    thread=threading.Thread(target=lambda: admitted.append(admission.enter()))
+    thread.start()
+    wait_for(lambda: admission.status()["queued"]==1)
+
+    assert not admission.enter()
+    assert admission.status()=={"in_flight": 1, "queued": 1, "jobs": 1, "queue_size": 1}
+
+    admission.leave(0.5)
+    thread.join(5)
+    assert admitted==[True] and admission.status()["in_flight"]==1 and admission.status()["queued"]==0
+
+    admission.leave(0.5)
+    assert admission.status()["in_flight"]==0
+
+def test_retry_after(server):
+    """
+    If the queue is full, Retry-After should be about how long the jobs ahead take to finish, and never less than a second
+    """
+
+    admission=server.Admission(jobs=2, queue_size=4)
+    assert admission.retry_after()==1
+
+    admission.queued=3
+    admission.average_seconds=3
+    assert admission.retry_after()==6
+
+    admission.queued=0
+    admission.average_seconds=1
+    for _ in range(50): #The average should follow how long compiles actually take
+        assert admission.enter()
+        admission.leave(11)
+    assert 10<admission.average_seconds<=11
+
+LABELS_CHANGED="LaTeX Warning: Label(s) may have changed. Rerun to get cross-references right."
+
+@pytest.mark.parametrize("log, previous, current, first, rerun", [
+    ("Output written on document.pdf (1 page).", {}, {".aux": "a"}, True, False), #Most resumes
+    ("LaTeX Warning: Reference `fig' on page 1 undefined.\n"+LABELS_CHANGED, {}, {".aux": "a"}, True, True),
+    ("LaTeX Warning: Citation `knuth' on page 1 undefined.\n"+LABELS_CHANGED, {}, {".aux": "a"}, True, True),
+    ("LaTeX Warning: There were undefined references.", {}, {".aux": "a"}, True, False), #Another pass won't define them
+    ("Package rerunfilecheck Warning: File `document.out' has changed.\n(rerunfilecheck) Rerun to get outlines right", {}, {".aux": "a", ".out": "o"}, True, True),
+    ("Package biblatex Warning: Please rerun LaTeX.", {}, {".aux": "a"}, True, True),
+    ("Output written on document.pdf (1 page).", {}, {".aux": "a", ".toc": "t"}, True, True), #The table of contents is only read on the next pass
+    ("Output written on document.pdf (1 page).", {".aux": "a", ".toc": "t"}, {".aux": "a", ".toc": "t"}, False, False),
+    ("Output written on document.pdf (1 page).", {".aux": "a"}, {".aux": "b"}, False, True),
+])
+def test_needs_rerun(log, previous, current, first, rerun):
+    """
+    If the log asks for another pass, or the auxiliary files it reads back changed, pdflatex should be rerun, but not otherwise
+    """
+
+    assert latex_driver.needs_rerun(log, previous, current, first)==rerun
+
+def fake_pdflatex(logs):
+    """
+    Returns a stand-in for Driver.run that writes a PDF and an unchanging .aux, and logs each of `logs` in turn (repeating the last one), along with the passes it has run
+    """
+    passes=[]
+
+    def run(directory, format_name, deadline, process=None):
+        passes.append(directory)
+        with open(os.path.join(directory, "document.pdf"), "wb") as f:
+            f.write(b"%PDF")
+        with open(os.path.join(directory, "document.aux"), "w") as f:
+            f.write("\\relax")
+        return 0, logs[min(len(passes), len(logs))-1]
+    return run, passes
+
+@pytest.mark.parametrize("logs, passes", [
+    (["Output written on document.pdf (1 page)."], 1),
+    ([LABELS_CHANGED, "Output written on document.pdf (1 page)."], 2),
+    ([LABELS_CHANGED], 3), #Never converges, so it stops at max_passes
+])
+def test_passes(tmp_path, monkeypatch, logs, passes):
+    """
+    If a document converges, pdflatex should stop running as soon as it does, and never run more than max_passes times
+    """
+
+    driver=latex_driver.Driver(directory=str(tmp_path), workers=0, max_passes=3)
+    run, runs=fake_pdflatex(logs)
+    monkeypatch.setattr(driver, "run", run)
+
+    pdf, log, code=driver.compile("\\relax")
+
+    assert pdf==b"%PDF" and code is None
+    assert len(runs)==passes and len(set(runs))==1 #Every pass runs in the same directory
+
+@pytest.mark.parametrize("returncode, log, elapsed, error", [
+    (0, "", 1, None),
+    (0, "! TeX capacity exceeded, sorry [main memory size=5000000].", 1, None), #It still finished
+    (1, "! Undefined control sequence.", 1, None),
+    (1, "! TeX capacity exceeded, sorry [main memory size=5000000].", 1, latex_driver.MEMORY_LIMIT),
+    (1, "pdflatex: Cannot allocate memory", 1, latex_driver.MEMORY_LIMIT),
+    (None, "", 30, latex_driver.TIMEOUT),
+    (-signal.SIGXCPU, "", 20, latex_driver.CPU_LIMIT),
+    (-signal.SIGKILL, "", 21, latex_driver.CPU_LIMIT), #Ignored SIGXCPU, so it was killed at the hard limit
+    (-signal.SIGKILL, "", 1, None), #Too soon to be the CPU limit
+    (-signal.SIGKILL, "! TeX capacity exceeded, sorry", 1, None),
+    (-signal.SIGXFSZ, "", 1, latex_driver.OUTPUT_LIMIT),
+])
+def test_limit_error(returncode, log, elapsed, error):
+    """
+    How pdflatex exited should be reported as the limit it ran into, if any
+    """
+
+    assert latex_driver.limit_error(returncode, log, elapsed, cpu_time=20)==error
+
+@pytest.mark.parametrize("returncode, failed", [
+    (1, True),
+    (None, False), #Timed out
+    (-signal.SIGKILL, False),
+])
+def test_format_failure(tmp_path, monkeypatch, returncode, failed):
+    """
+    A format that pdflatex couldn't dump should be marked as failed for good, but one that was cut off by a limit should be built again once its preamble is seen twice more
+    """
+
+    monkeypatch.setattr(latex_driver, "spawn", lambda *args: None)
+    monkeypatch.setattr(latex_driver, "wait", lambda *args: (returncode, ""))
+    formats=latex_driver.FormatCache(str(tmp_path))
+    formats.builder=threading.current_thread() #Builds are run below instead of in the background
+    latex="\\documentclass{article}\n"+latex_driver.BEGIN_DOCUMENT+"\nHello\n\\end{document}"
+
+    assert formats.lookup(latex) is None and formats.lookup(latex) is None
+    name, preamble=formats.builds.get(timeout=5)
+    formats.build(name, preamble)
+
+    assert (tmp_path/(name+".failed")).exists()==failed
+    assert (name in formats.formats)==failed
+    if not failed:
+        formats.lookup(latex)
+        formats.lookup(latex)
+        assert formats.builds.get(timeout=5)[0]==name
+
+def test_compile_all():
+    """
+    Each document's result should be yielded with its index as soon as it's done, even if documents before it in the batch are still compiling
+    """
+
+    def compile(latex):
+        time.sleep(float(latex))
+        return latex.encode(), "", None
+
+    results=[*latex_driver.compile_all(compile, ["0.3", "0", "0.1"], 3)]
+
+    assert [index for index, *_ in results]==[1, 2, 0]
+    assert all(pdf==latex.encode() for (index, pdf, *_), latex in zip(results, ["0", "0.1", "0.3"]))
+
+def test_batch_result():
+    """
+    A compiled document should be sent as a base64 PDF, and a failed one with its error code, and the limit it ran into or its log
+    """
+
+    assert latex_driver.batch_result(0, b"%PDF", "", None)=={"index": 0, "status": "ok", "pdf": "JVBERg=="}
+    assert latex_driver.batch_result(1, None, "! Undefined control sequence.", latex_driver.COMPILE_ERROR)=={"index": 1, "status": "error", "code": "compile_error", "error": "! Undefined control sequence."}
+    assert latex_driver.batch_result(2, None, "", latex_driver.TIMEOUT)=={"index": 2, "status": "error", "code": "timeout", "error": latex_driver.LIMIT_MESSAGES[latex_driver.TIMEOUT]}
+
+def test_batch_deadline(tmp_path):
+    """
+    A document from a batch that's out of time shouldn't be compiled at all
+    """
+
+    driver=latex_driver.Driver(directory=str(tmp_path), workers=0)
+
+    assert driver.compile("\\relax", deadline=time.monotonic())==(None, "", latex_driver.TIMEOUT)
+
+def test_batch_chunks(server):
+    """
+    A batch should be streamed as a chunked response, with a line of JSON per document in the order they finished, and end with an empty chunk
+    """
+
+    body=b"".join(server.batch_chunks([(1, b"%PDF", "", None), (0, None, "", latex_driver.MEMORY_LIMIT)]))
+
+    lines=[]
+    while True:
+        size, body=body.split(b"\r\n", 1)
+        size=int(size, 16)
+        assert body[size:size+2]==b"\r\n"
+        if size==0:
+            break
+        lines.append(json.loads(body[:size]))
+        body=body[size+2:]
+
+    assert body==b"\r\n"
+    assert lines==[
+        {"index": 1, "status": "ok", "pdf": "JVBERg=="},
+        {"index": 0, "status": "error", "code": "memory_limit", "error": latex_driver.LIMIT_MESSAGES[latex_driver.MEMORY_LIMIT]},
+    ]
+
+def test_format_in_use(tmp_path, monkeypatch):
+    """
+    A format that a compile was handed shouldn't be evicted (and so be mistaken for a broken format) until the compile releases it
+    """
+
+    def spawn(args, directory, env, limits):
+        name=next(arg for arg in args if arg.startswith("-jobname=")).removeprefix("-jobname=")
+        open(os.path.join(directory, name+".fmt"), "w").close()
+
+    monkeypatch.setattr(latex_driver, "spawn", spawn)
+    monkeypatch.setattr(latex_driver, "wait", lambda *args: (0, ""))
+    formats=latex_driver.FormatCache(str(tmp_path), size=1)
+    formats.builder=threading.current_thread() #Builds are run below instead of in the background
+
+    def build(title):
+        latex=f"\\documentclass{{article}}\\title{{{title}}}\n"+latex_driver.BEGIN_DOCUMENT+"\n\\end{document}"
+        formats.lookup(latex)
+        formats.lookup(latex)
+        formats.build(*formats.builds.get(timeout=5))
+        return latex
+
+    first=build("first")
+    name=formats.lookup(first)
+    assert name is not None
+
+    build("second")
+    assert (tmp_path/(name+".fmt")).exists() and formats.formats[name]
+
+    formats.release(name)
+    build("third")
+    assert not (tmp_path/(name+".fmt")).exists() and name not in formats.formats
+    assert not (tmp_path/(name+".failed")).exists()
+
+def test_batch_without_length(server):
+    """
+    A batch without a Content-Length should be rejected with a 400, instead of the connection being dropped
+    """
+
+    httpd=server.ThreadingHTTPServer(("127.0.0.1", 0), server.LaTeXCompiler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        with socket.create_connection(httpd.server_address, timeout=5) as connection:
+            connection.sendall(b"POST /batch HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+            response=b""
+            while chunk:=connection.recv(65536):
+                response+=chunk
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    head, body=response.split(b"\r\n\r\n", 1)
+    assert head.startswith(b"HTTP/1.1 400")
+    assert not json.loads(body)["success"]
@@ -0,0 +1,57 @@
+from . import *
+from ..dispatch import Handler
+
+def handler():
+    if scope is None:
+        scope="local"
+
+    output=scope+":"+str(token)
+
+def failing_handler():
+    partial=token
+
+    raise ValueError("Something went wrong")
+
+def test_parameters_are_local():
+    """
+    If a handler is dispatched, its parameters should be passed in as locals, without leaking into the module's globals
+    """
+
+    local_variables={}
+    Handler(handler, ["scope", "token"])(local_variables, {"scope": None, "token": "a"})
+
+    assert local_variables["output"]=="local:a"
+
+    assert "token" not in globals() and "scope" not in globals()
+
+def test_locals_kept_on_error():
+    """
+    If a handler raises an exception, the locals it defined up until then should still be returned
+    """
+
+    local_variables={}
+
+    with pytest.raises(ValueError):
+        Handler(failing_handler, ["token"])(local_variables, {"token": "a"})
+
+    assert local_variables["partial"]=="a"
+
+async def streaming_handler():
+    for i in range(count):
+        yield i
+
+    total=count
+
+def test_async_generator():
+    """
+    If a handler is an async generator, its values should be yielded in order, and its locals returned once it's exhausted
+    """
+
+    local_variables={}
+
+    async def collect():
+        return [x async for x in Handler(streaming_handler, ["count"])(local_variables, {"count": 3})]
+
+    assert asyncio.run(collect())==[0, 1, 2]
+
+    assert local_variables["total"]==3
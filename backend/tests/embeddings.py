@@ -0,0 +1,37 @@
+from . import *
+from ..embeddings import EmbeddingCache
+
+def fake_embed(calls):
+    def fetch(texts):
+        calls.append(texts)
+        return [[float(len(text)), 0.5] for text in texts]
+    return fetch
+
+def test_only_misses_are_fetched():
+    """
+    If a batch is partly cached, only the uncached texts (each one once) should be fetched, and the results should be in the original order
+    """
+
+    calls=[]
+    cache=EmbeddingCache()
+
+    assert cache.resolve("model", "task", ["a", "bb"], fake_embed(calls))==[[1.0, 0.5], [2.0, 0.5]]
+    assert cache.resolve("model", "task", ["ccc", "a", "ccc", "bb"], fake_embed(calls))==[[3.0, 0.5], [1.0, 0.5], [3.0, 0.5], [2.0, 0.5]]
+
+    assert calls==[["a", "bb"], ["ccc"]]
+
+    cache.resolve("other model", "task", ["a"], fake_embed(calls)) #Embeddings from different models can't be mixed
+    assert calls[-1]==["a"]
+
+def test_persistent_tier(tmp_path):
+    """
+    If the process restarts, embeddings should still be read from the SQLite tier instead of being fetched again
+    """
+
+    calls=[]
+    path=tmp_path / "embeddings.sqlite3"
+
+    EmbeddingCache(path=path).resolve("model", "task", ["a"], fake_embed(calls))
+    assert EmbeddingCache(path=path).resolve("model", "task", ["a"], fake_embed(calls))==[[1.0, 0.5]]
+
+    assert calls==[["a"]]
@@ -1,5 +1,6 @@
 from . import *
-import json, os, pathlib
+from .. import utils, generation
+import json, os, pathlib, base64, httpx
 
 token=None
 credentials=None
@@ -86,6 +87,22 @@ def test_points_valid(client):
     assert isinstance(points, str) and len(points)>0
 
 
+def test_points_cached(client, monkeypatch):
+    """
+    If the response cache is enabled and a user asks for the same points again, the cached points should be returned, unless they ask to regenerate them
+    """
+
+    monkeypatch.setattr(utils, "llm_cache", LRUCache(8))
+
+    first=is_success(client.post("/generate/points", json=credentials|{"ids":repos, "job_listing": job_listing}))["output"]
+
+    assert is_success(client.post("/generate/points", json=credentials|{"ids":repos, "job_listing": job_listing}))["output"]==first
+
+    hits=metrics.snapshot()[0].counters.get(("llm_cache_total", (("result", "hit"),)), 0)
+    is_success(client.post("/generate/points", json=credentials|{"ids":repos, "job_listing": job_listing, "regenerate": True}))
+    assert metrics.snapshot()[0].counters.get(("llm_cache_total", (("result", "hit"),)), 0)==hits
+
+
 def test_points_invalid(client):
     """
     If a user tries to call the endpoint with invalid repository ids, it should fail
@@ -110,6 +127,25 @@ def test_latex_valid(client):
     assert isinstance(latex, str) and len(latex)>0
 
 
+def test_latex_stream(client):
+    """
+    If a user streams the endpoint, the chunks should be sent before a final event with the cleaned up output and the filename
+    """
+
+    response=client.post("/generate/latex/stream", json=credentials|{"resume_id":resume_id, "input": points})
+
+    assert response.status_code==200
+
+    events=[json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    final=events[-1]
+    assert final["done"] and final["error"]==""
+
+    assert len(events)>1 and all("chunk" in event for event in events[:-1])
+
+    assert "```" not in final["output"] and final["filename"]==resume_filename
+
+
 def test_latex_invalid(client):
     """
     If a user tries to call the endpoint with an invalid resume_id, it should fail
@@ -117,6 +153,76 @@ def test_latex_invalid(client):
 
     is_error(client.post("/generate/latex", json=credentials|{"resume_id":-1, "input": points}))
 
+def test_pipeline(client):
+    """
+    If a user runs the pipeline with the stages they already approved, those stages should be skipped, and the final event should have the PDF
+    """
+
+    response=client.post("/generate/pipeline", json=credentials|{"resume_id": resume_id, "ids": repos, "points": points})
+
+    events=[json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert [event["status"] for event in events if event.get("stage") in ["rag", "points"]]==["skipped", "skipped"]
+
+    final=events[-1]
+    assert final["done"] and final["error"]==""
+
+    assert final["filename"]==resume_filename and len(base64.b64decode(final["pdf"]))>0
+
+def test_pipeline_invalid(client):
+    """
+    If a user runs the pipeline with a resume id that doesn't belong to them, it should fail
+    """
+
+    response=client.post("/generate/pipeline", json=credentials|{"resume_id": -1, "ids": repos, "points": points})
+
+    assert json.loads(response.get_data(as_text=True).splitlines()[-1])["error"]=="ValueError"
+
+def test_batch(client):
+    """
+    If a user tailors their resume to several job listings at once, there should be one result per listing, followed by the final event
+    """
+
+    response=client.post("/generate/batch", json=credentials|{"resume_id": resume_id, "job_listings": [job_listing, job_listing]})
+
+    events=[json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert sorted(event["index"] for event in events[:-1])==[0, 1]
+    assert all(event["error"]=="" and len(event["pdf"])>0 for event in events[:-1])
+
+    assert events[-1]["done"] and events[-1]["count"]==2
+
+def test_batch_compiled(client, monkeypatch):
+    """
+    If the compiler has a batch endpoint, listings that are ready at the same time should be compiled in the same request
+    """
+
+    calls=[]
+    async def compile_pdfs(contents):
+        calls.append(contents)
+        for index in range(len(contents)):
+            yield index, b"%PDF"
+
+    monkeypatch.setattr(generation, "COMPILER_BATCH", True)
+    monkeypatch.setattr(generation, "compile_pdfs", compile_pdfs)
+
+    response=client.post("/generate/batch", json=credentials|{"resume_id": resume_id, "job_listings": [job_listing, job_listing]})
+
+    events=[json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert all(event["error"]=="" and base64.b64decode(event["pdf"])==b"%PDF" for event in events[:-1])
+
+    assert sum(len(contents) for contents in calls)==2
+
+def test_batch_invalid(client):
+    """
+    If a user tries to tailor their resume to an empty list of job listings, it should fail
+    """
+
+    response=client.post("/generate/batch", json=credentials|{"resume_id": resume_id, "job_listings": []})
+
+    assert json.loads(response.get_data(as_text=True).splitlines()[-1])["error"]=="ValueError"
+
 def test_pdf_valid(client):
     """
     If a user tries to call the endpoint, it should succeed
@@ -130,9 +236,19 @@ def test_pdf_valid(client):
 
     assert f.seek(0, os.SEEK_END)>0
 
+def test_pdf_limit(client, monkeypatch):
+    """
+    If the compiler stops a document for running over one of its limits, the endpoint should fail with an error that says which one
+    """
 
+    class Compiler:
+        async def post(self, url, content, headers):
+            return httpx.Response(200, json={"statusCode": 500, "headers": {"Error-Message": "Compilation took too long", "Error-Code": "timeout"}, "body": "", "isBase64Encoded": True})
 
+    monkeypatch.setattr(generation, "get_compiler_client", Compiler)
 
+    response=client.post("/generate/pdf", json=credentials|{"filename": filename, "content": "\\def\\a{\\a}\\a"})
 
-    
+    is_error(response)
 
+    assert decode_form(response)["error"]=="CompilerTimeoutError"
@@ -0,0 +1,18 @@
+from . import *
+
+def test_metrics(client):
+    """
+    If a route was called, its request count and stage timings should be exposed by /metrics
+    """
+
+    is_error(client.post("/login", json={"email": "", "password": ""}))
+
+    response=client.get("/metrics")
+
+    assert response.status_code==200
+
+    text=response.get_data(as_text=True)
+
+    assert 'resumetailor_requests_total{route="/login",status="500"}' in text
+
+    assert 'resumetailor_stage_seconds_count{route="/login",stage="handler"}' in text
@@ -0,0 +1,73 @@
+from . import *
+from ..scheduler import Scheduler, TokenBucket
+from google.genai.errors import APIError
+
+def rate_limited(delay):
+    return APIError(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED", "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{delay}s"}]}})
+
+def flaky(errors):
+    """
+    Returns a function that raises each of `errors` in turn, then succeeds
+    """
+    errors=[*errors]
+    calls=[]
+
+    def function():
+        calls.append(time.monotonic())
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+    return function, calls
+
+def test_token_bucket():
+    """
+    If a key's burst is used up, the next call should have to wait for a token to be refilled
+    """
+
+    bucket=TokenBucket(rate=10, burst=2)
+
+    assert bucket.reserve()==0 and bucket.reserve()==0
+
+    assert 0.05<bucket.reserve()<=0.1
+
+def test_retry():
+    """
+    If Gemini is rate limited, the call should be retried after the delay it asked for, and the key should be slowed down
+    """
+
+    scheduler=Scheduler(rate=100, burst=100, retries=2)
+    function, calls=flaky([rate_limited(0.05)])
+
+    assert scheduler.call("key", function)=="ok"
+
+    assert len(calls)==2 and calls[1]-calls[0]>=0.05
+
+    assert scheduler.bucket("key")[0].rate<100
+
+def test_no_retry():
+    """
+    If Gemini rejects the request itself, or keeps failing past the retry limit, the error should be raised
+    """
+
+    scheduler=Scheduler(rate=100, burst=100, retries=1, backoff=0.01)
+
+    function, calls=flaky([APIError(400, {"error": {"code": 400}})])
+    with pytest.raises(APIError):
+        scheduler.call("key", function)
+    assert len(calls)==1
+
+    function, calls=flaky([APIError(503, {"error": {"code": 503}})]*2)
+    with pytest.raises(APIError):
+        asyncio.run(scheduler.acall("key", lambda: asyncio.to_thread(function)))
+    assert len(calls)==2
+
+def test_shared_key():
+    """
+    If several users go through the shared key, they should all draw from the same bucket
+    """
+
+    scheduler=Scheduler(shared_key="shared", shared_rate=1, shared_burst=1)
+
+    assert scheduler.bucket("shared")[0] is scheduler.shared
+
+    assert scheduler.bucket("a")[0] is not scheduler.bucket("b")[0]
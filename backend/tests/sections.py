@@ -0,0 +1,46 @@
+from . import *
+from .. import sections
+
+resume=r"""\documentclass{article}
+\begin{document}
+
+\section{Education}
+  \item {\bf School} --- 2020
+
+% \section{Old Projects}
+
+\section*{Projects}
+  \item First project
+
+\section{Skills}
+  \item Python
+\end{document}
+"""
+
+def test_find_sections():
+    """
+    If a resume has sections, they should be found in order (skipping commented out ones), with the last one ending at \\end{document}
+    """
+
+    found=sections.find_sections(resume)
+
+    assert [section.title for section in found]==["Education", "Projects", "Skills"]
+
+    assert sections.text_of(resume, found[-1])=="\\section{Skills}\n  \\item Python\n"
+
+    assert sections.find_section(resume, "project").title=="Projects"
+    assert sections.find_section(resume, "experience") is None
+
+def test_splice():
+    """
+    If a section is replaced, the rest of the resume should be left untouched, whether or not the replacement starts with the \\section line
+    """
+
+    section=sections.find_section(resume, "project")
+
+    new=sections.splice(resume, section, "\\section*{Projects}\n  \\item Second project")
+    assert new==resume.replace("First project", "Second project")
+
+    assert sections.splice(resume, section, "\n  \\item Second project\n")==new
+
+    assert "Education" in sections.style_sample(resume, section)
@@ -125,6 +125,21 @@ def test_modify_valid(client):
 
     user1=[email2, password2]
 
+def test_logout(client):
+    """
+    If a user logs out, the token they used should no longer be accepted, even if it hasn't expired yet.
+    """
+
+    _token=is_success(client.post("/login", json={"email": user1[0], "password": user1[1]}))["token"]
+
+    is_success(client.post("/logout", json={"token": _token}))
+
+    response=client.post("/github/selection/get", json={"token": _token})
+
+    is_error(response)
+
+    assert decode_form(response)["error"]=="StaleTokenError"
+
 def test_signup_new(client):
     global user2
     """
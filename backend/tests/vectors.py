@@ -0,0 +1,78 @@
+from . import *
+from ..vectors import ProjectIndex
+
+class Projects: #Stands in for the repository, and counts how many times each user's projects were loaded
+    def __init__(self):
+        self.rows={}
+        self.loads=0
+
+    def get_project_embeddings(self, uid):
+        self.loads+=1
+        return self.rows.get(uid, [])
+
+def project(id, embedding):
+    return {"id": id, "name": str(id), "url": f"https://github.com/{id}", "embedding": embedding}
+
+def test_match():
+    """
+    If a user matches their projects against an embedding, only the projects that score at least `minimum_score` should be returned, closest first, and at most `count` of them
+    """
+
+    projects=Projects()
+    projects.rows["a"]=[project(1, [1, 0, 0]), project(2, [0, 2, 0]), project(3, [0, 1, 1]), project(4, [0, 0, -1])]
+
+    index=ProjectIndex(projects)
+
+    assert [x["id"] for x in index.match_projects("a", [0, 1, 0.2], minimum_score=0.1, count=10)]==[2, 3]
+    assert [x["id"] for x in index.match_projects("a", [0, 1, 0.2], minimum_score=0, count=1)]==[2]
+    assert [x["id"] for x in index.match_projects("a", [0, 1, 0.2], minimum_score=-1, count=10)]==[2, 3, 1, 4]
+
+    assert index.match_projects("a", [0, 1, 0], minimum_score=0, count=1)==[{"id": 2, "name": "2", "url": "https://github.com/2"}]
+
+    assert index.match_projects("b", [0, 1, 0], minimum_score=0, count=10)==[]
+
+def test_invalidate():
+    """
+    If a user's projects are matched several times, they should only be loaded once, until they're invalidated (ie, by an import)
+    """
+
+    projects=Projects()
+    projects.rows["a"]=[project(1, [1, 0])]
+
+    index=ProjectIndex(projects)
+
+    index.match_projects("a", [1, 0], minimum_score=0, count=10)
+    index.match_projects("a", [1, 0], minimum_score=0, count=10)
+    assert projects.loads==1
+
+    projects.rows["a"]=[project(2, [1, 0])]
+    index.invalidate("a")
+
+    assert [x["id"] for x in index.match_projects("a", [1, 0], minimum_score=0, count=10)]==[2]
+    assert projects.loads==2
+
+def test_invalidate_during_load():
+    """
+    If a user's projects are invalidated while they're being loaded, the stale load shouldn't be cached, and nothing should be kept for the user once the loads are done
+    """
+
+    projects=Projects()
+    projects.rows["a"]=[project(1, [1, 0])]
+
+    index=ProjectIndex(projects)
+
+    load=projects.get_project_embeddings
+    def racing_load(uid): #An import finishes while the old projects are being loaded
+        rows=load(uid)
+        projects.rows["a"]=[project(2, [1, 0])]
+        index.invalidate(uid)
+        return rows
+    projects.get_project_embeddings=racing_load
+
+    assert [x["id"] for x in index.match_projects("a", [1, 0], minimum_score=0, count=10)]==[1]
+
+    projects.get_project_embeddings=load
+    assert [x["id"] for x in index.match_projects("a", [1, 0], minimum_score=0, count=10)]==[2]
+
+    index.invalidate("b")
+    assert index._versions=={} and index._loads=={}
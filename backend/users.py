@@ -43,7 +43,11 @@ def modify():
         update_dict["password"]=password
     #response=User.auth.update_user(update_dict) #This will not work, as modifying the email of as a user REQUIRES you to validate the new email --- unlike with signing up, there is NO option available in the dashboard for you to skip this
 
-    user=Admin.auth.admin.update_user_by_id(get_uid_from_token(token), update_dict).user
+    uid=get_uid_from_token(token)
+
+    user=Admin.auth.admin.update_user_by_id(uid, update_dict).user
+
+    revoke_sessions(uid) #Changing credentials may sign sessions out, so they should be checked against the database again
 
     if email is not None:
         email=user.email
@@ -66,9 +70,19 @@ def logout():
 
     Admin.auth.admin.sign_out(token, scope=scope)
 
+    context=auth_context.get()
+    if scope=="local":
+        revoke_sessions(context.uid, session_id=context.session_id)
+    else:
+        revoke_sessions(context.uid, keep=(context.session_id if scope=="others" else None))
+
 @endpoint("/delete", [])
 def delete():
-    Admin.auth.admin.delete_user(get_uid_from_token(token))
+    uid=get_uid_from_token(token)
+
+    Admin.auth.admin.delete_user(uid)
+
+    revoke_sessions(uid)
 
 
 
@@ -1,9 +1,19 @@
 from supabase import *
 from flask import Flask, request, url_for, Response
-import pathlib, sys, types, traceback, functools, json
-import dotenv, jwt, requests, sqlalchemy as sql
+import pathlib, sys, traceback, functools, json, contextvars, time, inspect, threading, asyncio, weakref, hashlib, queue
+import dotenv, jwt, requests, httpx, sqlalchemy as sql
 from requests_toolbelt import MultipartEncoder
 
+from .dispatch import Handler
+from .cache import LRUCache, BlobCache
+from .embeddings import EmbeddingCache
+from .vectors import ProjectIndex
+from .budget import estimate_tokens
+from .scheduler import Scheduler
+from .repository import PostgrestRepository, SQLRepository
+from . import metrics
+from .metrics import timer
+
 import google
 from google.genai.types import EmbedContentConfig
 
@@ -30,7 +40,29 @@ host=config["SUPABASE_PSQL_HOST"],
 port=int(config["SUPABASE_PSQL_PORT"]),
 database=config["SUPABASE_PSQL_DBNAME"],
 query={"sslmode": "disable"}
-))
+),
+pool_size=int(config.get("SQL_POOL_SIZE", 5)),
+max_overflow=int(config.get("SQL_POOL_OVERFLOW", 10)),
+pool_timeout=float(config.get("SQL_POOL_TIMEOUT", 30)),
+pool_recycle=int(config.get("SQL_POOL_RECYCLE", 1800)), #Recycle connections before Supabase's pooler drops them for being idle
+pool_pre_ping=True
+)
+
+#Hot-path queries go through the pooled engine, unless DATA_BACKEND says otherwise (or the database can't be reached)
+if config.get("DATA_BACKEND", "sql")=="postgrest":
+    repository=PostgrestRepository(User)
+else:
+    repository=SQLRepository(engine, prepare=(config.get("SQL_PREPARE", "1")=="1"), fallback=PostgrestRepository(User))
+
+#Projects are matched against a job listing in-process, unless RETRIEVAL_BACKEND says to use the pgvector function instead
+if config.get("RETRIEVAL_BACKEND", "local")=="pgvector":
+    retriever=repository
+else:
+    retriever=ProjectIndex(repository, maxsize=int(config.get("VECTOR_INDEX_SIZE", 1024)), ttl=float(config.get("VECTOR_INDEX_TTL", 300)))
+
+def invalidate_projects(uid): #Must be called whenever a user's rows in user_to_project change
+    if isinstance(retriever, ProjectIndex):
+        retriever.invalidate(uid)
 
 class Special: #Class for special arguments
     def __init__(self, arg):
@@ -45,44 +77,188 @@ class StaleTokenError(Exception):
     def __str__(self):
         return "This token has expired. Please /login or /refresh to get a new one."
 
-class PersistentLocals(object):
-    def __init__(self, func, locals_dict):
-        self._locals = {}
-        self.func = func
-        self.locals_dict=locals_dict
-
-    def __call__(self, *args, **kwargs): #https://code.activestate.com/recipes/577283-decorator-to-expose-local-variables-of-a-function-/
-        def tracer(frame, event, arg):
-            frame.f_trace_lines=False
-            frame.f_trace_opcodes=False
-
-            if (frame.f_code==self.func.__code__):
-                if event=='return':
-                    self._locals = frame.f_locals.copy()
-                elif event=='call':
-                    frame.f_locals.update(self.locals_dict)
-                    frame.f_globals.update(self.locals_dict)
-
-                    return tracer
-            else:
-                frame.f_trace=old_trace
-                    
-        old_trace=sys.gettrace()
-        sys.settrace(tracer)
-        try:
-            # trace the function call
-            res=self.func(*args, **kwargs)
-        finally:
-            # disable tracer and replace with old one
-            sys.settrace(old_trace)
-        return res
-
-    def clear_locals(self):
-        self._locals = {}
+AUTH_MODE=config.get("AUTH_MODE", "remote") #"remote" asks Supabase to validate every token, while "local" verifies the token's signature and expiry with SUPABASE_JWT_SECRET
+
+sessions=LRUCache(int(config.get("SESSION_CACHE_SIZE", 10000)), ttl=float(config.get("SESSION_CACHE_TTL", 60))) #Maps the ids of sessions known to be live to their uid. Used only when AUTH_MODE is "local"
+
+def decode_token(token, verify_exp=False):
+    try:
+        return jwt.decode(token, config["SUPABASE_JWT_SECRET"], algorithms=["HS256"], options={"verify_signature": True, "verify_aud":False, "verify_iss":False, "verify_exp": verify_exp, "verify_iat": False, "verify_nbf": False})
+    except jwt.InvalidTokenError:
+        raise StaleTokenError
+
+def is_live_session(session_id):
+    with timer("session"), engine.connect() as connection:
+        return connection.execute(sql.text("SELECT id FROM auth.sessions WHERE id = :id LIMIT 1"), {"id": session_id}).first() is not None
+
+class AuthContext:
+    """
+    The identity behind the token of the current request. It's resolved once by `endpoint`, so handlers and helpers don't need to ask Supabase again.
+    """
+    def __init__(self, token, uid, claims):
+        self.token=token
+        self.uid=uid
+        self.claims=claims
 
     @property
-    def locals(self):
-        return self._locals
+    def session_id(self):
+        return self.claims.get("session_id")
+
+auth_context=contextvars.ContextVar("auth_context", default=None)
+
+def authenticate(token): #https://supabase.com/docs/guides/auth/sessions#how-to-ensure-an-access-token-jwt-cannot-be-used-after-a-user-signs-out
+    """
+    Raises StaleTokenError if the token is invalid, expired, or belongs to a session that has been signed out. Otherwise, returns the token's AuthContext.
+    """
+    if AUTH_MODE=="local":
+        with timer("token"):
+            claims=decode_token(token, verify_exp=True)
+        session_id=claims.get("session_id")
+        uid=claims["sub"]
+
+        if sessions.get(session_id) is None:
+            if (session_id is None) or (not is_live_session(session_id)):
+                raise StaleTokenError
+            sessions.set(session_id, uid)
+    else:
+        with timer("token"):
+            try:
+                uid=User.auth.get_user(token).user.id
+            except:
+                raise StaleTokenError
+
+            claims=decode_token(token)
+
+        if not is_live_session(claims["session_id"]):
+            raise StaleTokenError
+
+    return AuthContext(token, uid, claims)
+
+def revoke_sessions(uid, session_id=None, keep=None):
+    """
+    Drops cached sessions once they have been signed out, so that AUTH_MODE="local" notices immediately instead of after SESSION_CACHE_TTL. If `session_id` is given, only that session is dropped; otherwise, every session of the user except `keep` is.
+    """
+    if session_id is not None:
+        sessions.pop(session_id)
+    else:
+        sessions.discard_where(lambda key, value: (value==uid) and (key!=keep))
+
+def record_request(route, start, status_code):
+    metrics.observe("request_seconds", time.perf_counter()-start, route=route)
+    metrics.increment("requests_total", route=route, status=status_code)
+
+def instrument(route):
+    """
+    Labels everything recorded while the view runs with `route`, and records the request's status code and total duration. Works on both regular and coroutine functions. An `EventStream` records its own request once it ends, since that's when the request is done.
+    """
+    def record(start, response, status_code):
+        if not isinstance(response, EventStream):
+            record_request(route, start, status_code)
+
+    def status_of(response):
+        if isinstance(response, EventStream):
+            return 200
+        return response.status_code if isinstance(response, Response) else response[1]
+
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(*args, **kwargs):
+                route_token=metrics.current_route.set(route)
+                start=time.perf_counter()
+                status_code=500
+                response=None
+                try:
+                    response=await view(*args, **kwargs)
+                    status_code=status_of(response)
+                    return response
+                finally:
+                    record(start, response, status_code)
+                    metrics.current_route.reset(route_token)
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            route_token=metrics.current_route.set(route)
+            start=time.perf_counter()
+            status_code=500
+            response=None
+            try:
+                response=view(*args, **kwargs)
+                status_code=status_of(response)
+                return response
+            finally:
+                record(start, response, status_code)
+                metrics.current_route.reset(route_token)
+        return wrapper
+    return decorator
+
+@app.route("/metrics", methods=["GET"])
+def metrics_():
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4")
+
+RESPONSE_CHUNK_SIZE=int(config.get("RESPONSE_CHUNK_SIZE", 64*1024)) #Size of the chunks that File outputs are streamed back in
+
+_loop=None
+_loop_lock=threading.Lock()
+
+def run_coroutine(coroutine):
+    """
+    Runs `coroutine` to completion from synchronous code (ie, a Flask worker thread), on an event loop shared by the whole process. Context variables (the request, the auth context, the current route, etc.) are carried over.
+
+    A single shared loop is used (rather than one per call) so that async clients, which are bound to the loop they were first used on, can be pooled.
+    """
+    try:
+        running_loop=asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop=None
+    if running_loop is not None:
+        raise RuntimeError("run_coroutine can't be called from a running event loop; await the coroutine instead")
+
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop()).result() #The callback that starts the task copies this thread's context
+
+def get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop=asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="endpoint-event-loop", daemon=True).start()
+    return _loop
+
+def parse_parameters(parameters):
+    """
+    Reads each of `parameters` from the current request, as either JSON (ie, from the body or from a "json" form field) or an uploaded file
+    """
+    parameters_map={} #Mapping parameters to their values 
+    
+    if request.is_json:
+        json_=request.json.copy()
+    else:
+        json_={}
+    
+    json_|=json.loads(request.form.get("json", "{}"))
+    for parameter in parameters:
+        cls=parameter.__class__
+        parameter=str(parameter)
+        if cls==File:
+            val=request.files.get(parameter, None)
+        else:
+            val=json_.get(parameter, None)
+        
+        parameters_map[parameter]=val
+
+    return parameters_map
+
+def record_error(local_variables, e):
+    local_variables["error"]=e.__class__.__name__
+    local_variables["message"]=str(e)
+
+    local_variables["status_code"]=500
+
+    if app.testing:
+        print(traceback.format_exc())
+
+endpoints={} #Maps the path of every endpoint with an async handler to its coroutine function, so that the ASGI app can await it directly
 
 def endpoint(endpoint, parameters, outputs=None):
     """
@@ -91,133 +267,429 @@ def endpoint(endpoint, parameters, outputs=None):
     Returns all of the locals whose names was specified by `outputs` in a single response JSON. The inclusion of both `error` and `message` are implied.
 
     This forces better self-documentation by not allowing the caller to use or return variables without specifying them ahead of time
+
+    The decorated function may also be a coroutine function (`async def`). Under Flask, it's run on a shared event loop; under the ASGI app (asgi.py), it's awaited directly, so a single process can have many of them waiting on I/O at once.
     """
 
     def decorator(f):
-        
-        @functools.wraps(f)
-        def wrapper(*args, **kwargs):
-            parameters_=parameters.copy()
+        parameters_=parameters.copy()
 
-            parameters_.append("token")
+        parameters_.append("token")
 
-            parameters_map={} #Mapping parameters to their values 
-            
-            if request.is_json:
-                json_=request.json.copy()
-            else:
-                json_={}
+        handler=Handler(f, [str(parameter) for parameter in parameters_]) #Compiled once, instead of on every request
+
+        if outputs is None:
+            outputs_=[]
+        else:
+            outputs_=outputs.copy()
+        outputs_.extend(["error", "message"])
+
+        def parse():
+            return parse_parameters(parameters_)
+
+        def respond(local_variables):
+            status_code=local_variables.get("status_code", 200)
+
+            for key in ["error", "message"]:
+                if key not in local_variables:
+                    local_variables[key]=""
             
-            json_|=json.loads(request.form.get("json", "{}"))
-            for parameter in parameters_:
-                cls=parameter.__class__
-                parameter=str(parameter)
-                if cls==File:
-                    val=request.files.get(parameter, None)
+            with timer("encode"):
+                json_outputs={}
+                file_outputs={}
+
+                for k in outputs_:
+                    cls=k.__class__
+                    k=str(k)
+
+                    if k not in local_variables:
+                        continue
+                    val=local_variables[k]
+
+                    if cls==File:
+                        file_outputs[k]=(val.name, val) #Read lazily by the encoder, instead of all at once
+                    elif cls==str:
+                        json_outputs[k]=val
+                if len(file_outputs)>0:
+                    m=MultipartEncoder(fields={"json": json.dumps(json_outputs)}|file_outputs)
+
+                    response=Response(iter(lambda: m.read(RESPONSE_CHUNK_SIZE), b""), content_type=m.content_type, status=status_code, headers={"Content-Length": str(m.len)}) #Stream the body, so that at most one chunk of it is in memory at a time
+                    for _, file in file_outputs.values():
+                        response.call_on_close(file.close)
                 else:
-                    val=json_.get(parameter, None)
-                
-                parameters_map[parameter]=val
-            
-            if outputs is None:
-                outputs_=[]
-            else:
-                outputs_=outputs.copy()
-            outputs_.extend(["error", "message"])
-            persistent_locals=PersistentLocals(f, parameters_map)
+                    response=(json_outputs, status_code)
+
+            return response
+
+        @functools.wraps(f)
+        async def async_wrapper():
+            parameters_map=parse()
+            local_variables={}
+            context_token=None
             try:
                 token=parameters_map["token"]
 
-                if (token is not None):  #https://supabase.com/docs/guides/auth/sessions#how-to-ensure-an-access-token-jwt-cannot-be-used-after-a-user-signs-out
-                    try:
-                        User.auth.get_user(token)
-                    except:
-                        raise StaleTokenError
-                    else:
-                        session_id=jwt.decode(token, config["SUPABASE_JWT_SECRET"], algorithms=["HS256"], options={"verify_signature": True, "verify_aud":False, "verify_iss":False, "verify_exp": False, "verify_iat": False, "verify_nbf": False})["session_id"]
+                if (token is not None):
+                    context_token=auth_context.set(await asyncio.to_thread(authenticate, token))
 
-                        with engine.connect() as connection:
-                            if connection.execute(sql.text("SELECT id FROM auth.sessions WHERE id = :id LIMIT 1"), {"id": session_id}).first() is None:
-                                raise StaleTokenError
-
-                persistent_locals(*args, **kwargs)
+                with timer("handler"):
+                    await handler(local_variables, parameters_map)
             except Exception as e:
-                persistent_locals.locals["error"]=e.__class__.__name__
-                persistent_locals.locals["message"]=str(e)
+                record_error(local_variables, e)
+            finally:
+                if context_token is not None:
+                    auth_context.reset(context_token)
 
-                persistent_locals.locals["status_code"]=500
+            return respond(local_variables)
 
-                if app.testing:
-                    print(traceback.format_exc())
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if handler.is_async:
+                return run_coroutine(async_wrapper())
 
-            status_code=persistent_locals.locals.get("status_code", 200)
+            parameters_map=parse()
+            local_variables={}
+            context_token=None
+            try:
+                token=parameters_map["token"]
 
-            for key in ["error", "message"]:
-                if key not in persistent_locals.locals:
-                    persistent_locals.locals[key]=""
-            
-            json_outputs={}
-            file_outputs={}
-
-            for k in outputs_:
-                cls=k.__class__
-                k=str(k)
-
-                if k not in persistent_locals.locals:
-                    continue
-                val=persistent_locals.locals[k]
-
-                if cls==File:
-                    file_outputs[k]=(val.name, val.read())
-                elif cls==str:
-                    json_outputs[k]=val
-            if len(file_outputs)>0:
-                m=MultipartEncoder(fields={"json": json.dumps(json_outputs)}|file_outputs)
-                
-                return Response(m.to_string(), content_type=m.content_type, status=status_code)
-            else:
-                return json_outputs, status_code
+                if (token is not None):
+                    context_token=auth_context.set(authenticate(token))
+
+                with timer("handler"):
+                    handler(local_variables, parameters_map)
+            except Exception as e:
+                record_error(local_variables, e)
+            finally:
+                if context_token is not None:
+                    auth_context.reset(context_token)
+
+            return respond(local_variables)
         
+        if handler.is_async:
+            endpoints[endpoint]=instrument(endpoint)(async_wrapper)
+
+        wrapper=instrument(endpoint)(wrapper)
         wrapper.__name__=(f.__module__+"."+f.__name__).replace(".", "_")
         wrapper=app.route(endpoint, methods=["POST"])(wrapper)
         #@app.route(endpoint, methods=["POST"])
         return wrapper
     return decorator
 
+class EventStream:
+    """
+    The response of a `stream_endpoint`: an async iterator over the already encoded events. Under ASGI, it's iterated directly on the server's loop; under Flask, it's run on the shared loop and handed over to the worker thread chunk by chunk.
+    """
+    def __init__(self, events, content_type):
+        self.events=events
+        self.content_type=content_type
+        self.headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"} #Stop proxies from holding back the events
+
+    def __aiter__(self):
+        return self.events
+
+    async def aclose(self):
+        await self.events.aclose()
+
+    def response(self):
+        """
+        Returns a Flask Response that streams the events. The events start being produced right away, with the current context (the route, etc.)
+        """
+        chunks=queue.Queue()
+
+        async def produce():
+            try:
+                async for chunk in self.events:
+                    chunks.put(chunk)
+            finally:
+                chunks.put(None)
+
+        future=asyncio.run_coroutine_threadsafe(produce(), get_loop())
+
+        def iterate():
+            try:
+                while (chunk:=chunks.get()) is not None:
+                    yield chunk
+            finally:
+                future.cancel() #ie, the client went away
+
+        return Response(iterate(), content_type=self.content_type, headers=self.headers)
+
+def stream_endpoint(endpoint, parameters, outputs=None):
+    """
+    Like `endpoint`, but the decorated function is an async generator, and every dict that it yields is sent to the client as soon as it's available. The events are sent as server-sent events if the client accepts `text/event-stream`, and as newline-delimited JSON otherwise.
+
+    Once the function finishes, a final event with `"done": true`, the locals named by `outputs`, and `error`/`message` is sent. Since the status code has already been sent by then, errors are only reported in that final event.
+    """
+
+    def decorator(f):
+        parameters_=[*parameters, "token"]
+
+        handler=Handler(f, [str(parameter) for parameter in parameters_])
+        if not handler.is_async_generator:
+            raise TypeError(f"{f.__name__} must be an async generator function")
+
+        outputs_=[*(outputs or []), "error", "message"]
+
+        async def events(parameters_map, encode, start):
+            local_variables={}
+            context_token=None
+            route_token=metrics.current_route.set(endpoint) #The events are produced after the view has returned (and reset its route)
+            try:
+                token=parameters_map["token"]
+
+                if (token is not None):
+                    context_token=auth_context.set(await asyncio.to_thread(authenticate, token))
+
+                with timer("handler"):
+                    async for event in handler(local_variables, parameters_map):
+                        yield encode(event)
+            except Exception as e:
+                record_error(local_variables, e)
+            finally:
+                if context_token is not None:
+                    auth_context.reset(context_token)
+
+            try:
+                yield encode({"done": True, "error": "", "message": ""}|{key: local_variables[key] for key in outputs_ if key in local_variables})
+            finally:
+                record_request(endpoint, start, 200)
+                metrics.current_route.reset(route_token)
+
+        def stream():
+            start=time.perf_counter()
+            if request.accept_mimetypes.best_match(["application/x-ndjson", "text/event-stream"])=="text/event-stream":
+                return EventStream(events(parse_parameters(parameters_), lambda event: f"data: {json.dumps(event)}\n\n".encode(), start), "text/event-stream")
+            return EventStream(events(parse_parameters(parameters_), lambda event: (json.dumps(event)+"\n").encode(), start), "application/x-ndjson")
+
+        @functools.wraps(f)
+        async def async_wrapper():
+            return stream()
+
+        instrumented_stream=instrument(endpoint)(stream) #Converted to a Response afterwards, so that `instrument` still leaves the request to the stream
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            return instrumented_stream().response()
+
+        endpoints[endpoint]=instrument(endpoint)(async_wrapper)
+
+        wrapper.__name__=(f.__module__+"."+f.__name__).replace(".", "_")
+        wrapper=app.route(endpoint, methods=["POST"])(wrapper)
+        return wrapper
+    return decorator
+
 def get_uid_from_token(token):
+    context=auth_context.get()
+    if (context is not None) and (context.token==token): #Already resolved when the request was authenticated
+        return context.uid
+
     return User.auth.get_user(token).user.id
 
-user_to_token_table=User.table("user_to_token")
+#Both caches are keyed by uid first, so that everything belonging to a user can be dropped when their tokens change
+credentials=LRUCache(int(config.get("CLIENT_POOL_SIZE", 256)), ttl=float(config.get("CLIENT_POOL_TTL", 600))) #Maps (uid, column) to the value stored in user_to_token
+clients=LRUCache(int(config.get("CLIENT_POOL_SIZE", 256)), ttl=float(config.get("CLIENT_POOL_TTL", 600))) #Maps (uid, kind, credential...) to a client, so that its connection pool is reused across requests
 
 def retrieve(token, column):
-    lst=user_to_token_table.select(column).eq("uid", get_uid_from_token(token)).execute().data
-    if len(lst)==0:
-        return None
-    else:
-        return lst[0][column]
-        
-def get_gemini_client(token):
+    uid=get_uid_from_token(token)
+
+    entry=credentials.get((uid, column))
+    if entry is None:
+        with timer("retrieve"):
+            entry=(repository.get_token(uid, column),) #Wrapped so that a missing value can be cached too
+        credentials.set((uid, column), entry)
+
+    return entry[0]
+
+def invalidate_credentials(uid): #Must be called whenever a user's row in user_to_token changes
+    credentials.discard_where(lambda key, value: key[0]==uid)
+    clients.discard_where(lambda key, value: key[0]==uid)
+
+def get_client(key, create):
+    """
+    Returns the pooled client at `key`, calling `create()` to build it if there isn't one yet.
+    """
+    client=clients.get(key)
+    if client is None:
+        client=create()
+        clients.set(key, client)
+    return client
+
+def get_gemini_key(token):
     _token=retrieve(token, "gemini")
     if not _token:
         _token=config["TEST_USER_GEMINI_TOKEN"]
+    return _token
+
+def get_gemini_client(token):
+    """
+    Returns the user's pooled Gemini client, along with the API key it uses (for `gemini_scheduler`)
+    """
+    _token=get_gemini_key(token)
+
+    return get_client((get_uid_from_token(token), "gemini", _token), lambda: google.genai.Client(api_key=_token)), _token
 
-    return google.genai.Client(api_key=_token)
+#Every call to Gemini goes through here, so that each API key (and the shared TEST_USER_GEMINI_TOKEN in particular) stays under its rate limit
+gemini_scheduler=Scheduler(
+    rate=float(config.get("GEMINI_RATE", 2)),
+    burst=int(config.get("GEMINI_BURST", 5)),
+    shared_key=config.get("TEST_USER_GEMINI_TOKEN"),
+    shared_rate=float(config.get("GEMINI_SHARED_RATE", 0.5)),
+    shared_burst=int(config.get("GEMINI_SHARED_BURST", 5)),
+    retries=int(config.get("GEMINI_RETRIES", 4)),
+    backoff=float(config.get("GEMINI_BACKOFF", 1)),
+    max_backoff=float(config.get("GEMINI_MAX_BACKOFF", 30)),
+)
 
-def get_embeddings(token, data):
-    embeddings=get_gemini_client(token).models.embed_content(
-        model="text-embedding-004",
-        contents=data, 
-        config=EmbedContentConfig(task_type="SEMANTIC_SIMILARITY")
-    ).embeddings
+EMBEDDING_MODEL="text-embedding-004"
+EMBEDDING_TASK_TYPE="SEMANTIC_SIMILARITY"
+LLM_MODEL="models/gemini-2.5-flash-preview-04-17"
 
-    return [x.values for x in embeddings]
+embedding_cache=EmbeddingCache(int(config.get("EMBEDDING_CACHE_SIZE", 4096)), config.get("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite3") or None) #An empty path keeps the cache in memory only
 
-def llm(token, content):
+def get_embeddings(token, data): #Only the texts that haven't been embedded before are sent to Gemini
+    def fetch(misses):
+        client, key=get_gemini_client(token)
+
+        with timer("gemini", call="embed_content"):
+            embeddings=gemini_scheduler.call(key, lambda: client.models.embed_content(
+                model=EMBEDDING_MODEL,
+                contents=misses, 
+                config=EmbedContentConfig(task_type=EMBEDDING_TASK_TYPE)
+            )).embeddings
+
+        return [x.values for x in embeddings]
+
+    return embedding_cache.resolve(EMBEDDING_MODEL, EMBEDDING_TASK_TYPE, data, fetch)
+
+PROMPT_TOKEN_BUDGET=int(config.get("PROMPT_TOKEN_BUDGET", 30000)) #Inputs are trimmed (see budget.py) to keep prompts within this many tokens
+
+_llm_cache_size=int(config.get("LLM_CACHE_SIZE", 0))
+llm_cache=LRUCache(_llm_cache_size, ttl=float(config.get("LLM_CACHE_TTL", 86400))) if _llm_cache_size>0 else None #Opt-in, since the same prompt may be expected to give a different answer each time
+
+def prompt_key(content):
+    """
+    Prompts that only differ in indentation or spacing are treated as the same prompt
+    """
+    normalized="\n".join(" ".join(line.split()) for line in content.strip().splitlines())
+    return (LLM_MODEL, hashlib.sha256(normalized.encode()).hexdigest())
+
+def prepare_prompt(content):
     content=content.strip()
-    
-    return get_gemini_client(token).models.generate_content(
-        model="models/gemini-2.5-flash-preview-04-17",
-        contents=content
-        ).text
+    metrics.observe("prompt_tokens", estimate_tokens(content), route=metrics.current_route.get())
+    return content, prompt_key(content)
+
+def cached_response(key, regenerate):
+    if (llm_cache is None) or regenerate:
+        return None
+
+    output=llm_cache.get(key)
+    metrics.increment("llm_cache_total", result="miss" if output is None else "hit")
+    return output
+
+def cache_response(key, output):
+    if llm_cache is not None:
+        llm_cache.set(key, output) #Also replaces the cached response when regenerating
+
+def llm(token, content, regenerate=False):
+    """
+    If `regenerate` is true, the response cache is skipped and Gemini is always asked
+    """
+    content, key=prepare_prompt(content)
+
+    output=cached_response(key, regenerate)
+    if output is not None:
+        return output
+
+    client, api_key=get_gemini_client(token)
+
+    with timer("gemini", call="generate_content"):
+        output=gemini_scheduler.call(api_key, lambda: client.models.generate_content(
+            model=LLM_MODEL,
+            contents=content
+            )).text
+
+    cache_response(key, output)
+    return output
+
+#Async versions of the above, for use in `async def` handlers. The client lookup may hit the database, so it's done in a thread
+
+async def aget_embeddings(token, data):
+    async def fetch(misses):
+        client, key=await asyncio.to_thread(get_gemini_client, token)
+
+        with timer("gemini", call="embed_content"):
+            embeddings=(await gemini_scheduler.acall(key, lambda: client.aio.models.embed_content(
+                model=EMBEDDING_MODEL,
+                contents=misses, 
+                config=EmbedContentConfig(task_type=EMBEDDING_TASK_TYPE)
+            ))).embeddings
+
+        return [x.values for x in embeddings]
+
+    return await embedding_cache.aresolve(EMBEDDING_MODEL, EMBEDDING_TASK_TYPE, data, fetch)
+
+async def allm(token, content, regenerate=False):
+    content, key=prepare_prompt(content)
+
+    output=cached_response(key, regenerate)
+    if output is not None:
+        return output
+
+    client, api_key=await asyncio.to_thread(get_gemini_client, token)
+
+    with timer("gemini", call="generate_content"):
+        output=(await gemini_scheduler.acall(api_key, lambda: client.aio.models.generate_content(
+            model=LLM_MODEL,
+            contents=content
+            ))).text
+
+    cache_response(key, output)
+    return output
+
+async def allm_stream(token, content, regenerate=False):
+    """
+    Yields the response in chunks as Gemini generates it. A cached response is yielded as a single chunk
+    """
+    content, key=prepare_prompt(content)
+
+    output=cached_response(key, regenerate)
+    if output is not None:
+        yield output
+        return
+
+    client, api_key=await asyncio.to_thread(get_gemini_client, token)
+
+    chunks=[]
+    start=time.perf_counter()
+    with timer("gemini", call="generate_content_stream"):
+        async for response in await gemini_scheduler.acall(api_key, lambda: client.aio.models.generate_content_stream( #Only starting the stream can be retried, since chunks may have been sent by the time it fails
+            model=LLM_MODEL,
+            contents=content
+            )):
+            if response.text:
+                if len(chunks)==0:
+                    metrics.observe("stage_seconds", time.perf_counter()-start, route=metrics.current_route.get(), stage="gemini_first_chunk")
+
+                chunks.append(response.text)
+                yield response.text
+
+    cache_response(key, "".join(chunks)) #Only reached if the whole response was generated
+
+COMPILER_PROTOCOL=config.get("COMPILER_PROTOCOL", "json") #"json" for the Lambda's envelope, "binary" for the raw PDF (docker/latex-compiler.py)
+COMPILER_COMPRESS=config.get("COMPILER_COMPRESS", "0")=="1"
+COMPILER_BATCH=config.get("COMPILER_BATCH", "0")=="1" #Whether the compiler has a /batch endpoint (both compilers in this repository do, but an older deployment may not)
+
+COMPILER_VERSION=config.get("COMPILER_VERSION", "") #Part of the PDF cache's keys, so that upgrading the compiler doesn't serve PDFs from the old one
+
+pdf_cache=BlobCache(int(config.get("PDF_CACHE_SIZE", 64*1024*1024)), config.get("PDF_CACHE_PATH", ".cache/pdfs") or None, int(config.get("PDF_CACHE_DISK_SIZE", 1024*1024*1024)))
+
+_compiler_clients=weakref.WeakKeyDictionary() #httpx.AsyncClient can only be used on the loop it was created on, so there's one per loop
 
+def get_compiler_client():
+    loop=asyncio.get_running_loop()
 
+    client=_compiler_clients.get(loop)
+    if client is None:
+        client=_compiler_clients[loop]=httpx.AsyncClient(timeout=float(config.get("COMPILER_TIMEOUT", 60)), limits=httpx.Limits(max_connections=int(config.get("COMPILER_POOL_SIZE", 20)), max_keepalive_connections=int(config.get("COMPILER_POOL_SIZE", 20)))) #Connections are kept alive between compiles
+    return client
@@ -0,0 +1,86 @@
+"""
+In-process retrieval for /generate/rag.
+
+Users only have a few dozen projects, so instead of asking pgvector to rank them (and then fetching their names and URLs in a second query), each user's embeddings are loaded once into a NumPy matrix, and ranked with a single matrix-vector product.
+"""
+import threading
+import numpy as np
+
+from .cache import LRUCache
+
+class UserIndex:
+    def __init__(self, projects):
+        self.projects=[{"id": project["id"], "name": project["name"], "url": project["url"]} for project in projects]
+
+        if len(projects)==0:
+            self.matrix=np.zeros((0, 0), dtype=np.float32)
+            return
+
+        matrix=np.asarray([project["embedding"] for project in projects], dtype=np.float32)
+        norms=np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.matrix=matrix/np.where(norms==0, 1, norms) #Normalized once, so that ranking only needs a dot product
+
+    def match(self, embedding, minimum_score, count):
+        if len(self.projects)==0 or count<=0:
+            return []
+
+        query=np.asarray(embedding, dtype=np.float32)
+        norm=np.linalg.norm(query)
+        if norm==0:
+            return []
+
+        scores=self.matrix@(query/norm) #Cosine similarity, ie, 1 - the cosine distance that pgvector's <=> returns
+
+        candidates=np.flatnonzero(scores>=minimum_score)
+        if len(candidates)>count:
+            candidates=candidates[np.argpartition(-scores[candidates], count-1)[:count]]
+
+        order=candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [self.projects[i] for i in order]
+
+class ProjectIndex:
+    """
+    Has the same `match_projects` method as the repositories, but ranks the projects locally. Each user's projects are loaded (with `repository.get_project_embeddings`) the first time they're matched, and kept until `invalidate` is called for them.
+    """
+    def __init__(self, repository, maxsize=1024, ttl=None):
+        """
+        `ttl` bounds how long an index can be stale for when another process imports the user's projects
+        """
+        self.repository=repository
+        self.indexes=LRUCache(maxsize, ttl=ttl)
+
+        self._loads={} #Maps uids to the number of loads in progress for them
+        self._versions={} #Bumped on every invalidation while a load is in progress, so that a load that raced with an import isn't cached. Only kept until the user's loads are done, so that it doesn't grow with every user
+        self._lock=threading.Lock()
+
+    def get(self, uid):
+        index=self.indexes.get(uid)
+        if index is not None:
+            return index
+
+        with self._lock:
+            self._loads[uid]=self._loads.get(uid, 0)+1
+            version=self._versions.get(uid, 0)
+
+        index=None
+        try:
+            index=UserIndex(self.repository.get_project_embeddings(uid))
+            return index
+        finally:
+            with self._lock:
+                if (index is not None) and (self._versions.get(uid, 0)==version):
+                    self.indexes.set(uid, index)
+
+                self._loads[uid]-=1
+                if self._loads[uid]==0:
+                    del self._loads[uid]
+                    self._versions.pop(uid, None)
+
+    def invalidate(self, uid): #Must be called whenever a user's rows in user_to_project change
+        with self._lock:
+            if uid in self._loads:
+                self._versions[uid]=self._versions.get(uid, 0)+1
+            self.indexes.pop(uid)
+
+    def match_projects(self, uid, embedding, minimum_score, count):
+        return self.get(uid).match(embedding, minimum_score, count)
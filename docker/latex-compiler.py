@@ -1,73 +1,258 @@
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import json
-import subprocess
 import base64
+import gzip
 import os
-import tempfile
+import math
+import threading
+import time
+
+import latex_driver
+
+MAX_ERROR_HEADER = 1000  # Error-Message has to fit in a single header line
+
+
+def error_summary(log):
+    """
+    Returns the lines of the pdflatex log that start with "!" (ie, the actual errors), on a single line that's safe to put in a header
+    """
+    lines = [line.strip() for line in log.splitlines() if line.startswith('!')] or log.strip().splitlines()[-1:]
+    summary = ' | '.join(lines)
+    return summary.encode('latin-1', 'replace').decode('latin-1')[:MAX_ERROR_HEADER]
+
+
+class Admission:
+    def __init__(self, jobs, queue_size):
+        """
+        Lets `jobs` compiles run at once, with up to `queue_size` more waiting for a turn
+        """
+        self.jobs = jobs
+        self.queue_size = queue_size
+
+        self.in_flight = 0
+        self.queued = 0
+        self.average_seconds = 1.0  # Moving average of how long a compile takes, for Retry-After
+
+        self._condition = threading.Condition()
+
+    def enter(self):
+        """
+        Waits for a turn to compile, or returns False right away if the queue is full
+        """
+        with self._condition:
+            if self.in_flight >= self.jobs and self.queued >= self.queue_size:
+                return False
+
+            self.queued += 1
+            while self.in_flight >= self.jobs:
+                self._condition.wait()
+            self.queued -= 1
+            self.in_flight += 1
+            return True
+
+    def leave(self, seconds):
+        with self._condition:
+            self.in_flight -= 1
+            self.average_seconds = 0.9 * self.average_seconds + 0.1 * seconds
+            self._condition.notify()
+
+    def retry_after(self):
+        """
+        Returns roughly how many seconds it will take for the queue to go down
+        """
+        with self._condition:
+            return max(1, math.ceil((self.queued + 1) / self.jobs * self.average_seconds))
+
+    def status(self):
+        with self._condition:
+            return {'in_flight': self.in_flight, 'queued': self.queued, 'jobs': self.jobs, 'queue_size': self.queue_size}
+
+
+jobs = min(int(os.environ.get('LATEX_WORKERS', os.cpu_count())), os.cpu_count())  # pdflatex is single-threaded, so more jobs than cores only makes each one slower
+admission = Admission(jobs, int(os.environ.get('LATEX_QUEUE_SIZE', jobs * 4)))
+
+limits = latex_driver.Limits(
+    timeout=float(os.environ.get('LATEX_TIMEOUT', 30)),
+    cpu_time=int(os.environ.get('LATEX_CPU_TIME', 20)),
+    memory=int(os.environ.get('LATEX_MEMORY', 1 << 30)),
+    output_size=int(os.environ.get('LATEX_OUTPUT_SIZE', 64 << 20))
+)
+
+MAX_BATCH_SIZE = int(os.environ.get('LATEX_MAX_BATCH_SIZE', 50))
+
+BUSY = 'busy'
+BUSY_MESSAGE = 'The compiler is busy, try again later'
+
+driver = latex_driver.Driver(workers=jobs, max_passes=int(os.environ.get('LATEX_MAX_PASSES', 3)), limits=limits)
+
+
+def compile_document(latex):
+    """
+    Returns the compiled PDF (or None if compilation failed), the pdflatex log, and the error code (ie, "timeout") if compilation failed
+    """
+    return driver.compile(latex)
+
+
+def chunk(data):
+    """
+    Returns `data` as one chunk of a chunked response (an empty chunk ends the response)
+    """
+    return f'{len(data):X}\r\n'.encode() + data + b'\r\n'
+
+
+def batch_chunks(results):
+    """
+    Yields a chunk with a line of JSON for each of `results` (from latex_driver.compile_all), and then the chunk that ends the response
+    """
+    for result in results:
+        yield chunk(json.dumps(latex_driver.batch_result(*result)).encode() + b'\n')
+    yield chunk(b'')
+
 
 class LaTeXCompiler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Lets the backend keep its connections open between compiles
+
+    def read_json(self):
+        content_length = int(self.headers.get('Content-Length', ''))  # A ValueError (ie, a 400) if it's missing
+        body = self.rfile.read(content_length)
+        if self.headers.get('Content-Encoding', '') == 'gzip':
+            body = gzip.decompress(body)
+
+        return json.loads(body)
+
+    def read_request(self):
+        data = self.read_json()
+        return data.get('latex', data.get('content'))  # The frontend sends "latex", the backend sends "content"
+
+    def send_body(self, status, content_type, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Expose-Headers', 'Error-Message, Error-Code, Retry-After')
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/status':
+            self.send_body(404, 'application/json', json.dumps({'error': 'Not found'}).encode())
+            return
+        self.send_body(200, 'application/json', json.dumps(admission.status()).encode())
+
+    def compile_one(self, latex):
+        """
+        Compiles a document from a batch once it gets a turn, or reports it as busy if the queue is full
+        """
+        if not admission.enter():
+            return None, BUSY_MESSAGE, BUSY
+
+        start = time.monotonic()
+        try:
+            return compile_document(latex)
+        finally:
+            admission.leave(time.monotonic() - start)
+
+    def compile_batch(self):
+        """
+        Compiles every document in {"documents": [...]} in parallel, and streams back a line of JSON for each one as soon as it's done (see latex_driver.batch_result)
+        """
+        try:
+            documents = self.read_json().get('documents')
+        except (ValueError, OSError):  # Not JSON, or not gzip
+            documents = None
+
+        if not isinstance(documents, list) or not all(isinstance(document, str) for document in documents) or not 0 < len(documents) <= MAX_BATCH_SIZE:
+            self.send_body(400, 'application/json', json.dumps({'success': False, 'error': f'documents must be a list of 1 to {MAX_BATCH_SIZE} LaTeX documents'}).encode())
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+
+        for data in batch_chunks(latex_driver.compile_all(self.compile_one, documents, jobs)):
+            self.wfile.write(data)
+            self.wfile.flush()  # So that each document is sent as soon as it's done
+
     def do_POST(self):
+        if self.path.split('?')[0] == '/batch':
+            self.compile_batch()
+            return
+
+        # Clients that accept application/pdf get the raw PDF back (and the log as text if it fails), instead of a base64 data URI inside JSON
+        binary = 'application/pdf' in self.headers.get('Accept', '')
+
+        if not admission.enter():
+            # Answer before reading the body, and drop the connection, so that a backlog doesn't pile up behind a full queue
+            self.close_connection = True
+            message = BUSY_MESSAGE
+            headers = {'Retry-After': str(admission.retry_after()), 'Connection': 'close'}
+            if binary:
+                self.send_body(503, 'text/plain; charset=utf-8', message.encode(), {**headers, 'Error-Message': message})
+            else:
+                self.send_body(503, 'application/json', json.dumps({'success': False, 'error': message}).encode(), headers)
+            return
+
+        start = time.monotonic()
         try:
-            content_length = int(self.headers['Content-Length'])
-            body = self.rfile.read(content_length)
-            data = json.loads(body)
-            
-            with tempfile.TemporaryDirectory() as tmpdir:
-                tex_file = os.path.join(tmpdir, 'document.tex')
-                with open(tex_file, 'w') as f:
-                    f.write(data['latex'])
-                
-                # Run pdflatex twice to resolve references
-                for _ in range(2):
-                    result = subprocess.run(
-                        ['pdflatex', '-interaction=nonstopmode', tex_file],
-                        cwd=tmpdir,
-                        capture_output=True,
-                        text=True
-                    )
-                
-                pdf_file = os.path.join(tmpdir, 'document.pdf')
-                if os.path.exists(pdf_file):
-                    with open(pdf_file, 'rb') as f:
-                        pdf_content = f.read()
-                        pdf_base64 = base64.b64encode(pdf_content).decode()
-                    
-                    # Send response headers in correct order
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-                    self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-                    self.end_headers()
-                    
-                    response = json.dumps({
-                        'success': True,
-                        'pdf': f'data:application/pdf;base64,{pdf_base64}'
-                    })
-                    self.wfile.write(response.encode())
+            try:
+                pdf_content, log, code = compile_document(self.read_request())
+            finally:
+                admission.leave(time.monotonic() - start)
+
+            message = latex_driver.LIMIT_MESSAGES.get(code)
+
+            if binary:
+                if pdf_content is None:
+                    self.send_body(422, 'text/plain; charset=utf-8', log.encode(), {'Error-Message': message or error_summary(log), 'Error-Code': code})
                 else:
-                    raise Exception(f'PDF generation failed:\n{result.stdout}\n{result.stderr}')
-                    
+                    self.send_body(200, 'application/pdf', pdf_content)
+                return
+
+            if pdf_content is None:
+                response = json.dumps({
+                    'success': False,
+                    'error': message or f'PDF generation failed:\n{log}',
+                    'code': code
+                })
+                self.send_body(500, 'application/json', response.encode())
+                return
+
+            pdf_base64 = base64.b64encode(pdf_content).decode()
+            response = json.dumps({
+                'success': True,
+                'pdf': f'data:application/pdf;base64,{pdf_base64}'
+            })
+            self.send_body(200, 'application/json', response.encode())
+
         except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
+            if binary:
+                self.send_body(500, 'text/plain; charset=utf-8', str(e).encode(), {'Error-Message': error_summary(str(e))})
+                return
+
             response = json.dumps({
                 'success': False,
                 'error': str(e)
             })
-            self.wfile.write(response.encode())
+            self.send_body(500, 'application/json', response.encode())
 
     def do_OPTIONS(self):
         # Handle preflight request
         self.send_response(204)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Content-Encoding')
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
 if __name__ == '__main__':
-    server = HTTPServer(('0.0.0.0', 3001), LaTeXCompiler)
+    server = ThreadingHTTPServer(('0.0.0.0', 3001), LaTeXCompiler)  # A kept-alive connection would otherwise block every other client
+    server.daemon_threads = True
+    driver.start()
     print('Starting LaTeX compilation server on port 3001...')
-    server.serve_forever()
\ No newline at end of file
+    server.serve_forever()
@@ -0,0 +1,456 @@
+"""
+Runs pdflatex for the Docker compile server (latex-compiler.py) and the Lambda (backend/compile-latex/main.py).
+
+Two things make a compile slow, aside from the document itself: starting pdflatex, and loading the packages in the preamble, which almost every resume shares. So:
+    * The second time a preamble is seen, it's dumped into a precompiled format (with mylatexformat) in the background, keyed by a hash of the preamble. Later documents with the same preamble load the format, and skip their preamble entirely.
+    * A few pdflatex processes are started ahead of time, and wait at their "**" prompt for the name of the document (and format) to compile.
+
+pdflatex is also only rerun when the document needs it (ie, to resolve cross-references), instead of a fixed number of times.
+
+Since the LaTeX usually comes from Gemini, it may never finish (ie, a macro that calls itself) or produce enormous output, so every pdflatex runs under the time, CPU, memory and output limits in `Limits`, and is killed (along with anything it started) once it runs over them.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import base64
+import hashlib
+import os
+import queue
+import re
+import resource
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+BEGIN_DOCUMENT = '\\begin{document}'
+
+DOCUMENT = 'document.tex'
+
+RERUN_PATTERN = re.compile(r'\brerun (to get|latex)\b', re.I)  # ie, "Label(s) may have changed. Rerun to get cross-references right.", "Rerun to get outlines right", "Please rerun LaTeX."
+
+AUX_EXTENSIONS = ['.aux', '.toc', '.lof', '.lot', '.out']
+
+DEFERRED_EXTENSIONS = ['.toc', '.lof', '.lot']  # Only read on the next pass, and pdflatex doesn't warn when they change
+
+SEEN_PREAMBLES = 1024  # Preambles that were only seen once, and so don't have a format yet
+
+MEMORY_PATTERN = re.compile(r'TeX capacity exceeded|memory exhausted|Cannot allocate memory|out of memory', re.I)
+
+# Why a compile failed, as reported to the backend
+COMPILE_ERROR = 'compile_error'
+TIMEOUT = 'timeout'
+CPU_LIMIT = 'cpu_limit'
+MEMORY_LIMIT = 'memory_limit'
+OUTPUT_LIMIT = 'output_limit'
+
+LIMIT_MESSAGES = {
+    TIMEOUT: 'Compilation took too long',
+    CPU_LIMIT: 'Compilation used too much CPU time',
+    MEMORY_LIMIT: 'Compilation ran out of memory',
+    OUTPUT_LIMIT: 'Compilation produced too much output',
+}
+
+
+class Limits:
+    def __init__(self, timeout=30, cpu_time=20, memory=1 << 30, output_size=64 << 20):
+        """
+        Each document gets `timeout` seconds (across every pass), and each pdflatex gets `cpu_time` seconds of CPU, `memory` bytes of address space, and can't write a file bigger than `output_size` bytes
+        """
+        self.timeout = timeout
+        self.cpu_time = cpu_time
+        self.memory = memory
+        self.output_size = output_size
+
+    def apply(self, pid):
+        resource.prlimit(pid, resource.RLIMIT_CPU, (self.cpu_time, self.cpu_time + 1))  # SIGXCPU at the soft limit, SIGKILL a second later
+        resource.prlimit(pid, resource.RLIMIT_AS, (self.memory, self.memory))
+        resource.prlimit(pid, resource.RLIMIT_FSIZE, (self.output_size, self.output_size))
+
+
+def spawn(args, directory, env, limits):
+    """
+    Starts pdflatex in its own process group (so that it can be killed along with anything it starts), under `limits`
+    """
+    process = subprocess.Popen(
+        ['pdflatex', *args],
+        cwd=directory,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        env=env,
+        start_new_session=True
+    )
+    limits.apply(process.pid)
+    return process
+
+
+def wait(process, line, deadline):
+    """
+    Sends `line` to pdflatex, and waits for it to finish until `deadline`. Returns its exit code (or None if it had to be killed) and its log.
+    """
+    try:
+        output, _ = process.communicate(line, timeout=max(deadline - time.monotonic(), 0))
+        return process.returncode, output
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        output, _ = process.communicate()
+        return None, output
+
+
+def limit_error(returncode, log, elapsed, cpu_time):
+    """
+    Returns which limit pdflatex ran into (given how many seconds it ran for, and its CPU limit), if any
+    """
+    if returncode == 0:
+        return None
+    if returncode is None:
+        return TIMEOUT
+    if returncode == -signal.SIGXCPU or (returncode == -signal.SIGKILL and elapsed >= cpu_time):  # ie, it ignored SIGXCPU and was killed at the hard limit, which can't happen any sooner than `cpu_time`
+        return CPU_LIMIT
+    if returncode == -signal.SIGXFSZ:
+        return OUTPUT_LIMIT
+    if returncode > 0 and MEMORY_PATTERN.search(log):  # ie, an allocation failed, or TeX ran out of its own memory
+        return MEMORY_LIMIT
+    return None
+
+
+def preamble_of(latex):
+    """
+    Returns everything before \\begin{document}, or None if the document doesn't have one
+    """
+    index = latex.find(BEGIN_DOCUMENT)
+    return latex[:index] if index >= 0 else None
+
+
+def first_line(format_name=None):
+    """
+    Returns what pdflatex should read as its first line: the format to load (if any), then the document
+    """
+    return ([f'&{format_name}'] if format_name else []) + [DOCUMENT]
+
+
+def aux_state(directory):
+    """
+    Returns a hash of each of the auxiliary files that pdflatex wrote for the document
+    """
+    state = {}
+    for extension in AUX_EXTENSIONS:
+        path = os.path.join(directory, 'document' + extension)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                state[extension] = hashlib.sha256(f.read()).hexdigest()
+    return state
+
+
+def needs_rerun(log, previous, current, first):
+    """
+    Returns whether another pass could change the output, given the log of the last pass and the auxiliary files before and after it
+    """
+    if RERUN_PATTERN.search(log):
+        return True
+    if first:
+        return any(extension in current for extension in DEFERRED_EXTENSIONS)  # The .aux is always written, and pdflatex already asks for a rerun if its labels changed
+    return current != previous
+
+
+def compile_all(compile, documents, workers):
+    """
+    Runs `compile` (ie, Driver.compile) on each of `documents`, `workers` at a time, and yields each document's index along with its result as soon as it's done
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(documents))))
+    try:
+        futures = {executor.submit(compile, latex): index for index, latex in enumerate(documents)}
+        for future in as_completed(futures):
+            yield (futures[future], *future.result())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)  # In case the client went away
+
+
+def batch_result(index, pdf, log, code):
+    """
+    Returns the line that a batch compile sends for a single document
+    """
+    if pdf is None:
+        return {'index': index, 'status': 'error', 'code': code, 'error': LIMIT_MESSAGES.get(code, log)}
+    return {'index': index, 'status': 'ok', 'pdf': base64.b64encode(pdf).decode()}
+
+
+class FormatCache:
+    def __init__(self, directory, size=16, env=None, limits=None, slots=None):
+        """
+        Keeps up to `size` formats in `directory`, evicting the least recently used (once no compile is using it)
+
+        Formats are built one at a time, and each build takes one of `slots` (shared with the compiles) while it runs, so that building doesn't add to the number of pdflatex processes running at once
+        """
+        self.directory = directory
+        self.size = size
+        self.env = env
+        self.limits = limits or Limits()
+        self.slots = slots or threading.Semaphore(1)
+
+        self.seen = OrderedDict()  # Preambles seen once (most recent last)
+        self.builds = queue.Queue()
+        self.builder = None
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.formats = OrderedDict()  # Maps preamble hashes to True (built), False (failed to build) or None (building)
+        self.in_use = {}  # Maps the formats handed out by `lookup` to the number of compiles that haven't released them yet
+        for filename in sorted(os.listdir(directory), key=lambda filename: os.path.getmtime(os.path.join(directory, filename))):  # Left over from an earlier process (ie, a warm Lambda whose runtime was restarted)
+            path = os.path.join(directory, filename)
+            name, extension = os.path.splitext(filename)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)  # A build that was interrupted
+            elif extension in ['.fmt', '.failed']:
+                self.formats[name] = extension == '.fmt'
+
+        self._lock = threading.Lock()
+
+    def lookup(self, latex):
+        """
+        Returns the name of the format for the document's preamble, if it has been built, which must be `release`d once the compile is done. Otherwise, if the preamble was seen before, queues it to be built, so that the next document with the same preamble can use it.
+        """
+        preamble = preamble_of(latex)
+        if preamble is None:
+            return None
+        name = 'preamble-' + hashlib.sha256(preamble.encode()).hexdigest()[:24]
+
+        with self._lock:
+            if name in self.formats:
+                self.formats.move_to_end(name)
+                if not self.formats[name]:
+                    return None
+                self.in_use[name] = self.in_use.get(name, 0) + 1
+                return name
+
+            if name not in self.seen:  # A one-off isn't worth a build
+                self.seen[name] = True
+                while len(self.seen) > SEEN_PREAMBLES:
+                    self.seen.popitem(last=False)
+                return None
+            del self.seen[name]
+            self.formats[name] = None
+
+            if self.builder is None:
+                self.builder = threading.Thread(target=self.build_queued, daemon=True)
+                self.builder.start()
+
+        self.builds.put((name, preamble))
+        return None
+
+    def release(self, name):
+        with self._lock:
+            self.in_use[name] -= 1
+            if self.in_use[name] == 0:
+                del self.in_use[name]
+
+    def build_queued(self):
+        while True:
+            name, preamble = self.builds.get()
+            with self.slots:
+                self.build(name, preamble)
+
+    def discard(self, name):
+        """
+        Stops using a format that didn't work
+        """
+        with self._lock:
+            self.formats[name] = False
+        self.remove(name)
+        self.mark_failed(name)
+
+    def remove(self, name):
+        for extension in ['.fmt', '.failed']:
+            try:
+                os.remove(os.path.join(self.directory, name + extension))
+            except FileNotFoundError:
+                pass
+
+    def mark_failed(self, name):
+        """
+        Remembers that the preamble can't be dumped, so that a later process doesn't try again
+        """
+        open(os.path.join(self.directory, name + '.failed'), 'w').close()
+
+    def build(self, name, preamble):
+        with tempfile.TemporaryDirectory(dir=self.directory) as tmpdir:
+            with open(os.path.join(tmpdir, 'preamble.tex'), 'w') as f:
+                f.write(preamble + BEGIN_DOCUMENT + '\n\\end{document}\n')
+
+            process = spawn(['-ini', '-interaction=nonstopmode', f'-jobname={name}', '&pdflatex', 'mylatexformat.ltx', 'preamble.tex'], tmpdir, self.env, self.limits)
+            returncode, _ = wait(process, '', time.monotonic() + self.limits.timeout)
+
+            built = os.path.join(tmpdir, name + '.fmt')
+            success = returncode == 0 and os.path.exists(built)
+            if success:
+                os.replace(built, os.path.join(self.directory, name + '.fmt'))
+            elif returncode is not None and returncode > 0:
+                self.mark_failed(name)  # The preamble itself can't be dumped
+            else:
+                with self._lock:  # It timed out or was killed (ie, the machine was busy), so give up for now, and build it again once the preamble is seen twice more
+                    self.formats.pop(name, None)
+                return
+
+        with self._lock:
+            self.formats[name] = success
+            evictable = [other for other in self.formats if other != name and other not in self.in_use]  # A compile that was handed a format may not have started pdflatex with it yet, so it's kept until then (and the cache may briefly be over `size`)
+            evicted = evictable[:max(len(self.formats) - self.size, 0)]
+            for evicted_name in evicted:
+                del self.formats[evicted_name]
+
+        for evicted_name in evicted:
+            self.remove(evicted_name)
+
+
+class WorkerPool:
+    def __init__(self, directory, size, env=None, limits=None):
+        """
+        Keeps `size` pdflatex processes waiting for a document, each in its own directory under `directory`
+        """
+        self.directory = directory
+        self.size = size
+        self.env = env
+        self.limits = limits or Limits()
+
+        shutil.rmtree(directory, ignore_errors=True)  # Jobs left behind by an earlier process, which no one will clean up otherwise
+        os.makedirs(directory, exist_ok=True)
+
+        self.workers = queue.Queue()
+
+    def start(self):
+        for _ in range(self.size - self.workers.qsize()):
+            self.workers.put(self.spawn())
+
+    def spawn(self):
+        directory = tempfile.mkdtemp(dir=self.directory, prefix='job-')
+        return spawn(['-interaction=nonstopmode'], directory, self.env, self.limits), directory
+
+    def take(self):
+        """
+        Returns a waiting pdflatex process and its (empty) directory, and starts another one in its place
+        """
+        while True:
+            try:
+                process, directory = self.workers.get_nowait()
+            except queue.Empty:
+                return None, tempfile.mkdtemp(dir=self.directory, prefix='job-')
+
+            threading.Thread(target=lambda: self.workers.put(self.spawn()), daemon=True).start()
+
+            if process.poll() is None:
+                return process, directory
+            shutil.rmtree(directory, ignore_errors=True)  # It died while waiting
+
+
+class Driver:
+    def __init__(self, directory=None, workers=None, formats=16, max_passes=3, limits=None, keep_fonts=False):
+        """
+        Keeps its formats and job directories under `directory` (by default, "latex" in the temporary directory), and runs pdflatex up to `max_passes` times per document
+
+        If `keep_fonts`, the fonts and font maps that TeX generates on demand (ie, with mktexpk) are kept under `directory` too, for when TeX's own TEXMFVAR isn't writable
+        """
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'latex')
+        self.max_passes = max_passes
+        self.limits = limits or Limits()
+
+        format_directory = os.path.join(self.directory, 'formats')
+        env = {**os.environ, 'TEXFORMATS': format_directory + os.pathsep}  # The trailing separator keeps pdflatex's own formats on the search path
+        if keep_fonts:
+            env['TEXMFVAR'] = os.path.join(self.directory, 'texmf-var')
+
+        workers = os.cpu_count() if workers is None else workers
+        self.slots = threading.Semaphore(max(workers, 1))  # pdflatex processes allowed to run at once, between compiles and format builds
+
+        self.formats = FormatCache(format_directory, formats, env, self.limits, self.slots)
+        self.workers = WorkerPool(os.path.join(self.directory, 'jobs'), workers, env, self.limits)
+        self.env = env
+
+    def start(self):
+        """
+        Starts the waiting pdflatex processes, so that the first compiles don't have to
+        """
+        self.workers.start()
+
+    def run(self, directory, format_name, deadline, process=None):
+        """
+        Runs one pass of pdflatex over the document in `directory` (with `process`, if it's waiting there), and returns its exit code (None if it ran out of time) and log
+        """
+        if process is not None:
+            return wait(process, ' '.join(first_line(format_name)) + '\n', deadline)
+
+        return wait(spawn(['-interaction=nonstopmode', *first_line(format_name)], directory, self.env, self.limits), '', deadline)
+
+    def output_error(self, pdf_file):
+        """
+        Returns OUTPUT_LIMIT if the PDF was cut off by the file size limit (in case pdflatex carried on instead of being killed by SIGXFSZ)
+        """
+        if os.path.exists(pdf_file) and os.path.getsize(pdf_file) >= self.limits.output_size:
+            return OUTPUT_LIMIT
+        return None
+
+    def compile(self, latex, strict=False, deadline=None):
+        """
+        Returns the compiled PDF (or None if compilation failed), the pdflatex log of the last pass, and why compilation failed (ie, COMPILE_ERROR or TIMEOUT), if it did. If `strict`, a document that had errors counts as failed, even if pdflatex managed to produce a PDF. `deadline` (from time.monotonic) cuts the document's time limit short, ie, for the rest of a batch.
+
+        pdflatex is only run again if the log asks for it, or if the auxiliary files it reads back changed, so most documents only take one pass.
+        """
+        deadline = min(time.monotonic() + self.limits.timeout, deadline or float('inf'))
+        if deadline <= time.monotonic() or not self.slots.acquire(timeout=deadline - time.monotonic()):  # Out of time before it started, or waiting on a format build
+            return None, '', TIMEOUT
+
+        try:
+            return self.compile_in_slot(latex, strict, deadline)
+        finally:
+            self.slots.release()
+
+    def compile_in_slot(self, latex, strict, deadline):
+        process, directory = self.workers.take()
+        looked_up = format_name = self.formats.lookup(latex)
+
+        try:
+            with open(os.path.join(directory, DOCUMENT), 'w') as f:
+                f.write(latex)
+
+            pdf_file = os.path.join(directory, 'document.pdf')
+            state = {}
+
+            for i in range(self.max_passes):
+                started = time.monotonic()
+                returncode, log = self.run(directory, format_name, deadline, process if i == 0 else None)  # A waiting process is only useful for the first pass, since the rest have to run in the same directory
+
+                error = limit_error(returncode, log, time.monotonic() - started, self.limits.cpu_time) or self.output_error(pdf_file)
+                if error is not None:
+                    return None, log, error
+
+                if i == 0 and format_name is not None and not os.path.exists(pdf_file):
+                    started = time.monotonic()
+                    returncode, log = self.run(directory, None, deadline)  # Try again without it, in case it's the format's fault
+
+                    error = limit_error(returncode, log, time.monotonic() - started, self.limits.cpu_time) or self.output_error(pdf_file)
+                    if error is not None:
+                        return None, log, error
+                    if os.path.exists(pdf_file):
+                        self.formats.discard(format_name)
+                    format_name = None
+
+                if not os.path.exists(pdf_file):
+                    break  # Another pass won't fix it
+
+                previous, state = state, aux_state(directory)
+                if not needs_rerun(log, previous, state, i == 0):
+                    break
+            if not os.path.exists(pdf_file) or (strict and returncode > 0):
+                return None, log, COMPILE_ERROR
+
+            with open(pdf_file, 'rb') as f:
+                return f.read(), log, None
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+            if looked_up is not None:
+                self.formats.release(looked_up)